@@ -1,35 +1,1246 @@
-import pandas as pd
+import time
+startupClock = time.time() # See startup_step
+import pandas as pd # Needed at startup anyway by the Tabulator widgets
 import datetime as dt
 import numpy as np
 import panel as pn
-from panel.layout.gridstack import GridStack
-import paramiko
 import os
 import io
-from io import StringIO, BytesIO
+from io import BytesIO
 from pathlib import Path
 import param
-import ipywidgets as ipw
-from tkinter import Tk, filedialog
-from glob import glob
-#Import for graphs
-import matplotlib
-from matplotlib import cm
-import plotly.express as px
-import plotly.graph_objects as go
+# panel_chemistry can't be imported lazily: the javascript of the viewer is only added to pages rendered after its import.
+# Other heavy modules are imported where they are used: paramiko (open_client), tkinter (select_files),
+# matplotlib (plotly_colorscale) and plotly (PAE figures).
 from panel_chemistry.pane import PDBeMolStar
 import json
 import sys
+import threading
+import codecs
+import hashlib
+import shlex
+import re
+import stat
+import queue
+import tarfile
+import tempfile
+import gzip
+import subprocess
+from collections import deque, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial, lru_cache
+import alphasub_a3m
+import alphasub_scores
+
+
+startupSteps = [] # (step, seconds) of the startup of the session
+
+def startup_step(name):
+    """
+    Record the time spent since the previous step. The report is printed at the end of the startup
+    when ALPHASUB_STARTUP_REPORT is set (use python -X importtime for the details of the imports).
+    """
+    global startupClock
+    now = time.time()
+    startupSteps.append((name, now - startupClock))
+    startupClock = now
 
+def startup_report():
+    total = sum(seconds for name, seconds in startupSteps)
+    lines = [f"{name:<20}{seconds*1000:8.0f} ms {100*seconds/max(total, 1e-9):5.1f} %" for name, seconds in startupSteps]
+    return "\n".join(["alphasub startup"] + lines + [f"{'total':<20}{total*1000:8.0f} ms"])
+
+startup_step("imports")
 
 
 #Loading external extension HERE (example, ngl, ipywidgets, terminal, tabulator.......)
-pn.extension('tabulator', 'terminal', 'ipywidgets','gridstack','plotly', sizing_mode = 'stretch_width', loading_spinner='dots')
+pn.extension('tabulator', 'terminal', 'plotly', sizing_mode = 'stretch_width', loading_spinner='dots')
 
 pn.config.notifications = True # Panel notification System 
 
 
+def run_in_ui(doc, func, *args, **kwargs):
+    """
+    Call func on the bokeh document of the session.
+    Widgets can't be safely modified from a worker thread, so every update coming from
+    a background job is scheduled on the next tick of the document (when there is one).
+    """
+    if doc is None:
+        return func(*args, **kwargs)
+    doc.add_next_tick_callback(partial(func, *args, **kwargs))
+
+
+def get_shared(name, factory):
+    """
+    Return an object shared by all the sessions of the server process.
+    panel serve re-executes this script for every browser session, so module level objects
+    are not shared: shared services are stored in pn.state.cache instead.
+    """
+    lock = pn.state.cache.setdefault("alphasub_lock", threading.RLock())
+    with lock:
+        if name not in pn.state.cache:
+            pn.state.cache[name] = factory()
+        return pn.state.cache[name]
+
+
+class SSHPool():
+    """
+    Pool of SSH connexions shared between jobs and browser sessions.
+    Connexions are keyed by (serverName, user, proxy, credentials) so the proxy handshake is done once,
+    and only a session giving the same password gets an authenticated connexion back.
+    Connexions are opened under a lock of their key only: a slow handshake doesn't hold the other servers.
+    Each entry keeps its SFTP subsystem, dead transports are reopened on the next request
+    and connexions unused for idleTimeout seconds are closed.
+    All the channels of a connexion count against the MaxSessions of sshd (maxSessions, 10 by default):
+    the SFTP channels of all the transfers on a connexion share transferChannels slots (see transfer_slots),
+    the rest is left to the exec channels and the shared SFTP client.
+    """
+
+    def __init__(self, keepalive=60, idleTimeout=1800, healthCheckDelay=30, maxSessions=10, transferChannels=4):
+        self.keepalive = keepalive
+        self.idleTimeout = idleTimeout
+        self.healthCheckDelay = healthCheckDelay # Only check idle connexions, active ones are known to work
+        self.maxSessions = maxSessions
+        self.transferChannels = transferChannels
+        self.lock = threading.RLock() # Short sections only, never held during network calls
+        self.connections = {}
+        self.keyLocks = {} # key -> lock held while the connexion of key is checked or opened
+        self.slots = {} # key -> semaphore of the transfer channels of the connexion
+        self.janitor = None
+
+    salt = os.urandom(16) # Only fingerprints of the passwords are kept in the keys, salted per process
+
+    @staticmethod
+    def make_key(parameters):
+        proxy = parameters.get("proxyAddress", "") if parameters.get("useProxy", False) else ""
+        password = parameters.get("password") or ""
+        credentials = hashlib.sha256(SSHPool.salt + password.encode()).hexdigest()[:16]
+        return (parameters["serverName"], parameters.get("user", ""), proxy, credentials)
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.keyLocks.setdefault(key, threading.RLock())
+
+    def is_alive(self, connection):
+        transport = connection["client"].get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if time.time() - connection["lastUsed"] > self.healthCheckDelay:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+    def get(self, key, factory):
+        """
+        Return a connected paramiko.SSHClient for key. factory() is called to open a new one
+        when there is none in the pool or when the previous one was dropped.
+        """
+        with self.lock:
+            self.start_janitor()
+        with self.key_lock(key):
+            connection = self.connections.get(key)
+            if connection is not None and not self.is_alive(connection):
+                self.close(key)
+                connection = None
+            if connection is None:
+                client = factory()
+                client.get_transport().set_keepalive(self.keepalive)
+                connection = {"client": client, "sftp": None, "lastUsed": time.time()}
+                with self.lock:
+                    self.connections[key] = connection
+            connection["lastUsed"] = time.time()
+            return connection["client"]
+
+    def transfer_slots(self, key):
+        with self.lock:
+            return self.slots.setdefault(key, threading.BoundedSemaphore(self.transferChannels))
+
+    def get_sftp(self, key, factory):
+        """
+        Return the SFTP client of the connexion (opened once and reused).
+        The SFTP client is shared, so always use absolute paths (no chdir).
+        """
+        with self.key_lock(key):
+            client = self.get(key, factory)
+            connection = self.connections[key]
+            sftp = connection["sftp"]
+            if sftp is None or sftp.sock.closed:
+                sftp = client.open_sftp()
+                connection["sftp"] = sftp
+            return sftp
+
+    def close(self, key):
+        with self.lock:
+            connection = self.connections.pop(key, None)
+            if connection is None:
+                return
+            try:
+                if connection["sftp"] is not None:
+                    connection["sftp"].close()
+                connection["client"].close()
+            except Exception:
+                pass #Already dead
+
+    def evict_idle(self):
+        with self.lock:
+            now = time.time()
+            for key in [k for k, c in self.connections.items() if now - c["lastUsed"] > self.idleTimeout]:
+                self.close(key)
+
+    def start_janitor(self):
+        if self.janitor is not None:
+            return
+        def janitor():
+            while True:
+                time.sleep(self.keepalive)
+                self.evict_idle()
+        self.janitor = threading.Thread(target=janitor, daemon=True)
+        self.janitor.start()
+
+
+class SFTPTransfer():
+    """
+    Upload of many files through a bounded pool of SFTP channels opened on the pooled connexion.
+    slots (see SSHPool.transfer_slots) bounds the channels of all the transfers running on the connexion.
+    Writes of blockSize bytes are pipelined (paramiko reads the acknowledgements as they come and at close).
+    Files already on the host with the same size and sha256 are skipped, and interrupted uploads
+    (name.part on the host) are resumed when the partial file matches the start of the content.
+    """
+
+    def __init__(self, host, channels=4, blockSize=32768, slots=None, stateChunk=200):
+        self.HOST = host
+        self.maxChannels = max(1, channels)
+        self.slots = slots
+        self.blockSize = blockSize
+        self.stateChunk = stateChunk # Files per remote_state command, about 250 bytes of command each
+        self.channels = queue.Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def get_channel(self):
+        with self.lock:
+            if self.channels.empty() and self.opened < self.maxChannels:
+                #The first channel waits for a slot of the connexion, the next ones are only opened if a slot is free
+                if self.slots is None or self.slots.acquire(blocking=self.opened == 0):
+                    try:
+                        sftp = self.HOST.ssh.open_sftp()
+                    except Exception:
+                        if self.slots is not None:
+                            self.slots.release()
+                        raise
+                    self.opened += 1
+                    return sftp
+        return self.channels.get()
+
+    def close(self):
+        while not self.channels.empty():
+            self.channels.get().close()
+        if self.slots is not None:
+            for i in range(self.opened):
+                self.slots.release()
+        self.opened = 0
+
+    def remote_state(self, folder, files):
+        """
+        Size of each file on the host and its sha256 when the size matches, or the size and sha256 of
+        the partial upload. Returns {name: (kind, size, sha256)}.
+        One command per stateChunk files, so the command line stays well below the limits of the server.
+        """
+        files = list(files)
+        state = {}
+        for start in range(0, len(files), self.stateChunk):
+            chunk = files[start:start+self.stateChunk]
+            dirs = sorted(set(os.path.dirname(name) for name, content in chunk if os.path.dirname(name) != ""))
+            lines = [f"cd {shlex.quote(folder)} || exit 1"]
+            if len(dirs) > 0:
+                lines.append(f"mkdir -p {' '.join(shlex.quote(d) for d in dirs)}")
+            for name, content in chunk:
+                q = shlex.quote(name)
+                lines.append(f"if [ -f {q} ]; then s=$(stat -c %s {q}); h=; [ \"$s\" = {len(content)} ] && h=$(sha256sum < {q} | cut -c1-64); printf 'F\\t%s\\t%s\\t%s\\n' \"$s\" \"$h\" {q}; "
+                             f"elif [ -f {q}.part ]; then printf 'P\\t%s\\t%s\\t%s\\n' $(stat -c %s {q}.part) $(sha256sum < {q}.part | cut -c1-64) {q}; fi")
+            for line in self.HOST.query("\n".join(lines)).splitlines():
+                fields = line.split("\t")
+                if len(fields) == 4:
+                    state[fields[3]] = (fields[0], int(fields[1]), fields[2])
+        return state
+
+    def upload_file(self, folder, name, content, state):
+        """
+        Upload (or resume) one file. Returns the number of bytes sent.
+        """
+        kind, size, digest = state if state is not None else (None, 0, "")
+        if kind == "F" and size == len(content) and digest == hashlib.sha256(content).hexdigest():
+            return 0
+        offset = 0
+        if kind == "P" and size <= len(content) and digest == hashlib.sha256(content[:size]).hexdigest():
+            offset = size
+        data = memoryview(content) # No copy of the whole file, only blockSize at a time
+        remote = f"{folder}/{name}"
+        sftp = self.get_channel()
+        try:
+            with sftp.open(remote+".part", "r+" if offset > 0 else "w", bufsize=0) as f:
+                f.set_pipelined(True)
+                f.seek(offset)
+                for start in range(offset, len(content), self.blockSize):
+                    f.write(bytes(data[start:start+self.blockSize]))
+            try:
+                sftp.posix_rename(remote+".part", remote)
+            except IOError:
+                #No posix-rename extension on the server
+                try:
+                    sftp.remove(remote)
+                except IOError:
+                    pass
+                sftp.rename(remote+".part", remote)
+        finally:
+            self.channels.put(sftp)
+        return len(content) - offset
+
+    def upload(self, folder, files):
+        """
+        Upload the list of (relative path, content) in folder on the host.
+        Returns a dict with the numbers of files sent and skipped, bytes sent, duration and throughput.
+        """
+        start = time.time()
+        state = self.remote_state(folder, files)
+        try:
+            with ThreadPoolExecutor(max_workers=self.maxChannels) as executor:
+                sent = list(executor.map(lambda item: self.upload_file(folder, item[0], item[1], state.get(item[0])), files))
+        finally:
+            self.close()
+        duration = max(time.time() - start, 1e-6)
+        report = {"files": sum(1 for n in sent if n > 0),
+                  "skipped": sum(1 for n in sent if n == 0),
+                  "bytes": sum(sent),
+                  "seconds": duration,
+                  "MBps": sum(sent) / duration / 1e6,
+                  }
+        return report
+
+
+LocalAttributes = namedtuple("LocalAttributes", ["filename", "st_size", "st_mtime", "st_mode"])
+
+
+class LocalSFTP():
+    """
+    The few SFTP calls used outside of the transfers (putfo, get, stat, listdir_attr), on the local disk.
+    Returned by Host.get_sftp() when the host is the local machine.
+    """
+
+    def putfo(self, fo, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path+".part", "wb") as f:
+            f.write(fo.read())
+        os.replace(path+".part", path)
+
+    def get(self, path, local):
+        with open(path, "rb") as src, open(local, "wb") as dst:
+            dst.write(src.read())
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def listdir_attr(self, folder):
+        entries = []
+        for entry in os.scandir(folder):
+            attr = entry.stat()
+            entries.append(LocalAttributes(entry.name, attr.st_size, attr.st_mtime, attr.st_mode))
+        return entries
+
+    def close(self):
+        pass
+
+
+class LocalTransfer():
+    """
+    Counterpart of SFTPTransfer when the host is the local machine: files are written straight to disk
+    (through name.part, then renamed), files already there with the same content are skipped.
+    """
+
+    def __init__(self, host):
+        self.HOST = host
+
+    def write_file(self, folder, name, content):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.path.getsize(path) == len(content):
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).digest() == hashlib.sha256(content).digest():
+                    return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path+".part", "wb") as f:
+            f.write(content)
+        os.replace(path+".part", path)
+        return len(content)
+
+    def upload(self, folder, files):
+        """
+        Same arguments and report as SFTPTransfer.upload.
+        """
+        start = time.time()
+        sent = [self.write_file(folder, name, content) for name, content in files]
+        duration = max(time.time() - start, 1e-6)
+        return {"files": sum(1 for n in sent if n > 0),
+                "skipped": sum(1 for n in sent if n == 0),
+                "bytes": sum(sent),
+                "seconds": duration,
+                "MBps": sum(sent) / duration / 1e6,
+                }
+
+
+def parse_fasta(text):
+    """
+    Parse a fasta file content and return a list of (name, sequence).
+    Sequences can be on several lines. Sequences without header are named seqN.
+    """
+    entries = []
+    name = None
+    seq = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line == "":
+            continue
+        if line.startswith(">"):
+            if name is not None or len(seq) > 0:
+                entries.append((name if name is not None else f"seq{len(entries)}", "".join(seq)))
+            name = line[1:].strip()
+            seq = []
+        else:
+            seq.append(line)
+    if name is not None or len(seq) > 0:
+        entries.append((name if name is not None else f"seq{len(entries)}", "".join(seq)))
+    return entries
+
+
+def msa_cache_key(sequence, parameters):
+    """
+    Key of a query in the MSA cache: hash of the normalised sequence and of the search parameters.
+    """
+    sequence = "".join(sequence.split()).upper().rstrip("*")
+    content = json.dumps({"sequence": sequence, "parameters": parameters}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def database_resident_command(files):
+    """
+    Shell command printing the percentage (integer) of files resident in the page cache of the node.
+    Uses vmtouch when installed, otherwise fincore (util-linux). Prints nothing if none is available.
+    """
+    return (f"if command -v vmtouch > /dev/null 2>&1; then "
+            f"vmtouch {files} 2>/dev/null | awk '/Resident Pages/ {{gsub(\"%\",\"\",$NF); print int($NF)}}'; "
+            f"elif command -v fincore > /dev/null 2>&1; then "
+            f"fincore --bytes --noheadings --raw --output RES,SIZE {files} 2>/dev/null | awk '{{r+=$1; s+=$2}} END {{if (s>0) {{p=int(100*r/s); print (p>100 ? 100 : p)}}}}'; "
+            f"fi")
+
+
+def database_preload_command(files):
+    """
+    Shell command reading files into the page cache of the node (vmtouch -t, or a plain sequential read).
+    """
+    return (f"if command -v vmtouch > /dev/null 2>&1; then vmtouch -t {files}; "
+            f"else cat {files} > /dev/null; fi")
+
+
+def estimate_gpu_memory(nres, depth=None):
+    """
+    Rough GPU memory (MiB) needed by AlphaFold for nres residues (all chains).
+    The pair representation grows with nres², on top of ~2 GB for the weights and the runtime.
+    The extra MSA stack (at most 5120 sequences, 256 bytes per residue and sequence) grows with
+    the MSA depth, unknown before the search (depth None), then the maximum is assumed.
+    """
+    depth = 5120 if depth is None else min(depth, 5120)
+    return int(2000 + 0.0025 * nres**2 + depth * nres * 256 / 2**20)
+
+
+def estimate_resources(residues, nmodels=5, recycles=3, relax=True, gpuRelax=True, search=False, depth=None):
+    """
+    Rough resources of one colabfold_batch run over predictions of the given sizes (total residues,
+    one value per prediction, predictions are made one after the other).
+    GPU memory (MiB) and host memory (GB) are those of the largest prediction, the walltime is the sum of all.
+    Timings are for a GTX1080Ti/RTX2080Ti class GPU, with a 1.5 safety margin and at least one hour.
+    """
+    residues = [n for n in residues if n > 0] or [0]
+    nres = max(residues)
+    seconds = 0
+    for n in residues:
+        forward = 10 + 5e-5 * n**2 + 1e-8 * n**3 # One pass of the network (s)
+        model = 60 + forward * (recycles + 1) # Compilation then the recycles
+        if relax:
+            model += (0.05 if gpuRelax else 0.5) * n # Amber minimisation
+        seconds += nmodels * model
+    if search:
+        seconds += 600 + 120 * len(residues)
+    seconds = int(max(3600, 1.5 * seconds))
+    mem = int(np.ceil(8 + 4e-6 * nres**2 + (4 if relax and not gpuRelax else 0)))
+    return {"residues": nres,
+            "gpuMemory": estimate_gpu_memory(nres, depth),
+            "mem": mem,
+            "seconds": seconds,
+            "walltime": f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}",
+            }
+
+
+def process_pool(workers):
+    """
+    ProcessPoolExecutor whose workers can import the modules next to this script
+    (panel serve only puts the script folder in sys.path while the script runs).
+    The initializer is a standard library function so it can be pickled whatever the start method.
+    """
+    import site
+    folder = os.path.dirname(os.path.abspath(__file__))
+    return ProcessPoolExecutor(max_workers=max(1, workers), initializer=site.addsitedir, initargs=(folder,))
+
+
+def load_pae(path, cacheDir="~/.alphasub/pae_cache"):
+    """
+    Return the PAE matrix of a *_scores.json file as a float16 array memory-mapped from a .npy sidecar.
+    The JSON is only parsed the first time (or when it is newer than the sidecar). The sidecar is written
+    next to the scores file, or in cacheDir when the predictions folder is read-only.
+    """
+    candidates = [path+".pae.npy",
+                  os.path.join(os.path.expanduser(cacheDir), hashlib.sha1(os.path.abspath(path).encode()).hexdigest()+".npy")]
+    mtime = os.path.getmtime(path)
+    for sidecar in candidates:
+        if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= mtime:
+            return np.load(sidecar, mmap_mode="r")
+
+    with open(path, "r") as f:
+        mat = np.asarray(json.load(f)["pae"], dtype=np.float16)
+    for sidecar in candidates:
+        try:
+            os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+            #Other sessions may be mapping the sidecar: write a temporary file and rename it
+            fd, tmp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(sidecar))
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, mat)
+            os.replace(tmp, sidecar)
+            return np.load(sidecar, mmap_mode="r")
+        except OSError:
+            continue
+    return mat
+
+
+def downsample_matrix(mat, maxCells, rows=None, cols=None):
+    """
+    Block-average the region rows x cols (slices, full matrix by default) of mat so that it has at most
+    maxCells cells per side. Returns the matrix and the residue coordinates (1-based, block centers)
+    of its rows and columns.
+    """
+    rows = slice(0, mat.shape[0]) if rows is None else rows
+    cols = slice(0, mat.shape[1]) if cols is None else cols
+    region = np.asarray(mat[rows, cols], dtype=np.float32)
+    factor = max(1, int(np.ceil(max(region.shape) / maxCells)))
+    if factor > 1:
+        nr, nc = int(np.ceil(region.shape[0]/factor)), int(np.ceil(region.shape[1]/factor))
+        padded = np.full((nr*factor, nc*factor), np.nan, dtype=np.float32)
+        padded[:region.shape[0], :region.shape[1]] = region
+        region = np.nanmean(padded.reshape(nr, factor, nc, factor), axis=(1, 3))
+    y = rows.start + 1 + np.arange(region.shape[0])*factor + (factor-1)/2
+    x = cols.start + 1 + np.arange(region.shape[1])*factor + (factor-1)/2
+    return region, x, y
+
+
+@lru_cache(maxsize=None)
+def plotly_colorscale(name, entries=255):
+    """
+    Convert a matplotlib colormap into a plotly colorscale (computed once per process).
+    """
+    import matplotlib.cm
+    positions = np.linspace(0, 1, entries)
+    colors = (matplotlib.cm.get_cmap(name)(positions)[:, :3]*255).astype(np.uint8)
+    return tuple((float(position), f"rgb({r}, {g}, {b})") for position, (r, g, b) in zip(positions, colors))
+
+
+@lru_cache(maxsize=None)
+def pae_layout():
+    """
+    Layout shared by all the PAE heatmaps (computed once per process).
+    """
+    import plotly.graph_objects as go
+    return go.Layout(xaxis_title="Residue", yaxis_title="Residue", margin=dict(l=40, r=10, t=10, b=40))
+
+
+def pack_files(files):
+    """
+    gzip compressed tar archive (bytes) of the list of (relative path, content).
+    Timestamps are fixed so the same files always give the same archive (and can be skipped by SFTPTransfer).
+    """
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            tar.addfile(info, BytesIO(content))
+    return gzip.compress(buffer.getvalue(), compresslevel=6, mtime=0)
+
+
+A3M_HELPER_NAME = "alphasub_a3m.py" # Shipped with every job, see alphasub_a3m.py
+A3M_HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), A3M_HELPER_NAME)
+
+
+def chunk_list(items, size):
+    """
+    Split items in lists of at most size elements.
+    """
+    size = max(1, int(size))
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+class JobStatus():
+    """
+    Status of one submitted job.
+    The stages follow the sentinel files written by the generated run_pred.sh.
+    """
+    STAGES = ["pending", "queued", "uploading", "submitted", "searching", "modelling", "done", "failed"]
+
+    def __init__(self, jobname, workdir, server, doModels=True):
+        self.jobname = jobname
+        self.workdir = workdir
+        self.server = server
+        self.doModels = doModels
+        self.stage = "pending"
+        self.message = ""
+        self.scripts = ["run_pred.sh"] # Scripts to launch in order (search then models when stages are split)
+        self.placement = None # (node, GPU index) chosen by the GPUScheduler
+        self.requiredMemory = 0 # Estimated GPU memory (MiB)
+        self.resources = None # Estimated resources, see estimate_resources
+        self.pbsIds = []
+        self.batch = None # BatchManifest the job belongs to (batch mode only)
+        self.queue = "" # PBS state and position in the queue, set by the JobTracker
+        self.submitted = dt.datetime.now()
+        self.updated = self.submitted
+
+    def set_stage(self, stage, message=""):
+        if stage not in self.STAGES:
+            raise ValueError(f"Unknown stage {stage}")
+        self.stage = stage
+        self.message = message
+        self.updated = dt.datetime.now()
+
+    def stage_from_files(self, files):
+        """
+        Deduce the stage from the list of files present in the workdir.
+        Returns None if no sentinel file was found (job still in the queue).
+        """
+        files = set(files)
+        if "makingModelsDone" in files:
+            return "done"
+        if "makingModels" in files:
+            return "modelling"
+        if "searchingSequencesDone" in files:
+            return "searching" if self.doModels else "done"
+        if "searchingSequences" in files:
+            return "searching"
+        return None
+
+    @property
+    def finished(self):
+        return self.stage in ("done", "failed")
+
+    def elapsed(self):
+        end = self.updated if self.finished else dt.datetime.now()
+        return str(end - self.submitted).split(".")[0]
+
+    def as_dict(self):
+        return {"Job": self.jobname,
+                "Server": self.server,
+                "Stage": self.stage,
+                "PBS id": ",".join(self.pbsIds),
+                "Submitted": self.submitted.strftime("%Y-%m-%d %H:%M:%S"),
+                "Updated": self.updated.strftime("%H:%M:%S"),
+                "Elapsed": self.elapsed(),
+                "Queue": self.queue,
+                "Message": self.message,
+                }
+
+
+class BatchManifest():
+    """
+    Manifest of a batch submission: one JobStatus per chunk of the fasta file.
+    It is written as batch_manifest.json in the batch workdir every time a chunk changes stage.
+    """
+
+    def __init__(self, jobname, workdir, chunkSize):
+        self.jobname = jobname
+        self.workdir = workdir
+        self.chunkSize = chunkSize
+        self.created = dt.datetime.now()
+        self.jobs = []
+        self.sequences = {} # chunk workdir -> sequence names
+        self.lock = threading.Lock()
+
+    def add(self, job, names):
+        job.batch = self
+        self.jobs.append(job)
+        self.sequences[job.workdir] = names
+
+    def summary(self):
+        stages = [job.stage for job in self.jobs]
+        return {stage: stages.count(stage) for stage in JobStatus.STAGES if stages.count(stage) > 0}
+
+    def to_dict(self):
+        return {"jobname": self.jobname,
+                "workdir": self.workdir,
+                "chunkSize": self.chunkSize,
+                "created": self.created.strftime("%Y-%m-%d %H:%M:%S"),
+                "summary": self.summary(),
+                "chunks": [{"name": job.jobname,
+                            "workdir": job.workdir,
+                            "sequences": self.sequences[job.workdir],
+                            "pbsIds": job.pbsIds,
+                            "stage": job.stage,
+                            "message": job.message,
+                            } for job in self.jobs],
+                }
+
+    def save(self, sftp):
+        with self.lock:
+            content = json.dumps(self.to_dict(), indent=2)
+            sftp.putfo(BytesIO(content.encode()), f"{self.workdir}/batch_manifest.json")
+
+
+
+class SharedService():
+    """
+    Base of the services shared by all the sessions of a server process (see get_shared).
+    Every session using the service attaches its Host: commands go through the last attached one
+    (they all draw from the same pooled connexion) and messages are written in all their terminals.
+    """
+
+    def __init__(self, host=None):
+        self.hosts = []
+        self.hostsLock = threading.Lock()
+        if host is not None:
+            self.attach(host)
+
+    @property
+    def HOST(self):
+        hosts = self.hosts
+        return hosts[-1] if len(hosts) > 0 else None
+
+    def attach(self, host):
+        with self.hostsLock:
+            if host not in self.hosts:
+                self.hosts = self.hosts + [host]
+
+    def detach(self, host):
+        """
+        Remove host, return the number of hosts still attached.
+        """
+        with self.hostsLock:
+            self.hosts = [h for h in self.hosts if h is not host]
+            return len(self.hosts)
+
+    def log(self, message):
+        hosts = self.hosts
+        if len(hosts) == 0:
+            sys.stderr.write(message) #No session left, only the server log
+        for host in hosts:
+            host.write_terminal(message)
+
+
+class JobTracker(SharedService):
+    """
+    Follow all the submitted jobs of a host. Every interval seconds a single SSH command lists
+    the sentinel files of every workdir (one find over all of them) and the PBS queue (one qstat),
+    so the cost of a poll doesn't grow with the number of jobs.
+    The setStage(job, stage, message) given with a job is called when it changes stage (job.set_stage
+    by default), listeners are called after each poll.
+    """
+    SENTINELS = ["searchingSequences", "searchingSequencesDone", "makingModels", "makingModelsDone"]
+
+    def __init__(self, host=None, interval=30):
+        SharedService.__init__(self, host)
+        self.interval = interval
+        self.jobs = {} # workdir -> JobStatus
+        self.callbacks = {} # workdir -> setStage of the session that submitted the job
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.thread = None
+        self.running = False
+
+    def add(self, job, setStage=None):
+        with self.lock:
+            self.jobs[job.workdir.rstrip("/")] = job
+            self.callbacks[job.workdir.rstrip("/")] = setStage
+        self.start()
+
+    def set_stage(self, job, stage, message=""):
+        setStage = self.callbacks.get(job.workdir.rstrip("/"))
+        if setStage is None:
+            job.set_stage(stage, message)
+        else:
+            setStage(job, stage, message)
+
+    def poll_command(self, workdirs, qstat):
+        names = " -o ".join(f"-name {name}" for name in self.SENTINELS)
+        find = f"find {' '.join(shlex.quote(w) for w in workdirs)} -maxdepth 1 \\( {names} \\) -printf '%h\\t%f\\n' 2>/dev/null"
+        #qstat first: a job missing from the queue has written its last sentinel file before the find
+        if qstat:
+            return f"qstat 2>/dev/null; echo __QSTAT__ $?; {find}"
+        return f"echo __QSTAT__ 1; {find}"
+
+    @staticmethod
+    def parse_qstat(lines):
+        """
+        Return {numeric job id: (state, queue, position)} from the default qstat output.
+        position is the rank among the queued (Q) jobs of the same queue, in submission order.
+        """
+        jobs = {}
+        waiting = {}
+        started = False
+        for line in lines:
+            if line.startswith("---"):
+                started = True
+                continue
+            fields = line.split()
+            if not started or len(fields) < 6:
+                continue
+            jobid, state, queue = fields[0].split(".")[0], fields[-2], fields[-1]
+            position = None
+            if state == "Q":
+                waiting[queue] = waiting.get(queue, 0) + 1
+                position = waiting[queue]
+            jobs[jobid] = (state, queue, position)
+        return jobs
+
+    def poll(self):
+        host = self.HOST
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if not job.finished]
+        if len(jobs) == 0 or host is None:
+            return []
+        qsub = host.executor != "bash"
+        out = host.query(self.poll_command([job.workdir.rstrip("/") for job in jobs], qsub)).splitlines()
+        marker = [i for i, line in enumerate(out) if line.startswith("__QSTAT__")]
+        if len(marker) == 0:
+            raise RuntimeError("Unexpected output while polling the jobs")
+        qstatOk = out[marker[0]].split()[-1] == "0"
+        queue = self.parse_qstat(out[:marker[0]]) if qstatOk else {}
+        files = {}
+        for line in out[marker[0]+1:]:
+            if "\t" in line:
+                folder, name = line.split("\t", 1)
+                files.setdefault(folder, []).append(name)
+
+        changed = []
+        for job in jobs:
+            stage = job.stage_from_files(files.get(job.workdir.rstrip("/"), []))
+            ids = [pbsId.split(".")[0] for pbsId in job.pbsIds]
+            states = [queue[i] for i in ids if i in queue]
+            job.queue = ""
+            if len(states) > 0:
+                state, name, position = states[0]
+                job.queue = f"{state} {name}" + (f" #{position}" if position is not None else "")
+            elif qstatOk and len(ids) > 0 and stage != "done":
+                #Every PBS job left the queue without the final sentinel file
+                stage = "failed"
+                self.set_stage(job, stage, "PBS job ended before the end of the run")
+                changed.append(job)
+                continue
+            if stage is not None and stage != job.stage and not job.finished:
+                self.set_stage(job, stage)
+                changed.append(job)
+        for listener in list(self.listeners):
+            listener(jobs)
+        return changed
+
+    def start(self):
+        self.running = True
+        if self.thread is not None and self.thread.is_alive():
+            return
+        def follow():
+            while self.running:
+                time.sleep(self.interval)
+                try:
+                    self.poll()
+                except Exception as e:
+                    self.log(f"\nCannot poll the jobs: {e}\n")
+        self.thread = threading.Thread(target=follow, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+
+NVIDIA_SMI_QUERY = "nvidia-smi --query-gpu=index,name,temperature.gpu,utilization.gpu,utilization.memory,memory.total,memory.used,memory.free --format=csv,noheader,nounits"
+NVIDIA_SMI_COLUMNS = ["node", "gpu", "name", "temperature", "util", "memUtil", "total", "used", "free"]
+
+
+def parse_nvidia_smi(out, node=None):
+    """
+    Parse the output of NVIDIA_SMI_QUERY (no header, no units) into a list of dict.
+    Values not reported by the card ([N/A]) are NaN.
+    """
+    rows = []
+    for line in out.splitlines():
+        fields = [field.strip() for field in line.split(",")]
+        if len(fields) != len(NVIDIA_SMI_COLUMNS)-1 or not fields[0].isdigit():
+            continue
+        row = {"node": node, "gpu": int(fields[0]), "name": fields[1]}
+        for column, value in zip(NVIDIA_SMI_COLUMNS[3:], fields[2:]):
+            try:
+                row[column] = float(value)
+            except ValueError:
+                row[column] = np.nan
+        rows.append(row)
+    return rows
+
+
+class GPUTelemetry(SharedService):
+    """
+    Background collector of the GPU state of all the nodes of a server.
+    Every interval seconds all nodes are polled at the same time; the last state is kept in a table
+    and the (time, utilisation, used memory) samples of each GPU in a ring buffer of historySize samples.
+    listeners are called with the table after each poll.
+    """
+
+    def __init__(self, host, nodes, interval=10, historySize=360):
+        SharedService.__init__(self, host)
+        self.nodes = nodes # node numbers (None for a single machine)
+        self.interval = interval
+        self.historySize = historySize
+        self.table = pd.DataFrame(columns=NVIDIA_SMI_COLUMNS)
+        self.history = {} # (node, gpu) -> deque of (time, util, used)
+        self.updated = 0
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.thread = None
+        self.running = False
+
+    def poll_node(self, node, host):
+        return parse_nvidia_smi(host.query(host.node_command(NVIDIA_SMI_QUERY, node)), node)
+
+    def poll(self):
+        """
+        Query all the nodes at the same time, refresh the table and the history.
+        """
+        host = self.HOST
+        if host is None:
+            return self.table
+        with ThreadPoolExecutor(max_workers=max(1, len(self.nodes))) as executor:
+            results = list(executor.map(lambda node: self.poll_node(node, host), self.nodes))
+        rows = [row for result in results for row in result]
+        now = time.time()
+        with self.lock:
+            self.table = pd.DataFrame(rows, columns=NVIDIA_SMI_COLUMNS)
+            for row in rows:
+                key = (row["node"], row["gpu"])
+                if key not in self.history:
+                    self.history[key] = deque(maxlen=self.historySize)
+                self.history[key].append((now, row["util"], row["used"]))
+            self.updated = now
+        for listener in list(self.listeners):
+            listener(self.table)
+        return self.table
+
+    def snapshot(self, maxAge=None):
+        """
+        Last table, polled again if older than maxAge seconds (default: the polling interval).
+        """
+        maxAge = self.interval if maxAge is None else maxAge
+        if time.time() - self.updated > maxAge:
+            return self.poll()
+        return self.table
+
+    def start(self):
+        self.running = True
+        if self.thread is not None and self.thread.is_alive():
+            return
+        def collect():
+            while self.running:
+                try:
+                    self.poll()
+                except Exception as e:
+                    self.log(f"\nCannot poll the GPUs: {e}\n")
+                time.sleep(self.interval)
+        self.thread = threading.Thread(target=collect, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+
+class GPUScheduler():
+    """
+    Place jobs on the best free (node, GPU) pair among all the nodes of a server.
+    The GPU state comes from the GPUTelemetry of the server. A GPU is free when almost no memory is used
+    on it and no job was placed on it recently. The free GPU with the smallest memory still large
+    enough for the job is chosen, so big GPUs stay available for big jobs.
+    Jobs are queued locally when nothing fits and placed as soon as a GPU becomes free, a job larger
+    than every GPU of the server is refused.
+    Reservations are files of reservationDir (holding the time of the reservation), so the processes of
+    panel serve --num-procs and the command line don't place two jobs on the same idle GPU.
+    """
+
+    def __init__(self, telemetry, interval=30, idleMemory=120, reservationDelay=600, reservationDir="~/.alphasub/gpu_reservations"):
+        self.telemetry = telemetry
+        self.interval = interval # seconds between two placement attempts when jobs are waiting
+        self.idleMemory = idleMemory # MiB, below this a GPU is considered free
+        self.reservationDelay = reservationDelay # seconds a GPU stays reserved for a job that is starting
+        self.reservationDir = os.path.expanduser(reservationDir)
+        self.table = pd.DataFrame(columns=NVIDIA_SMI_COLUMNS)
+        self.queue = deque()
+        self.lock = threading.RLock()
+        self.worker = None
+
+    def poll(self):
+        with self.lock:
+            self.table = self.telemetry.snapshot()
+        return self.table
+
+    def reserve(self, placement):
+        """
+        Reserve the (node, gpu) placement for reservationDelay seconds. False if it is already reserved
+        (by any process of the machine).
+        """
+        import fcntl
+        os.makedirs(self.reservationDir, exist_ok=True)
+        now = time.time()
+        with open(os.path.join(self.reservationDir, f"{placement[0]}_{placement[1]}"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                if now - float(f.read().strip()) < self.reservationDelay:
+                    return False
+            except ValueError:
+                pass #New file
+            f.seek(0)
+            f.truncate()
+            f.write(str(now))
+        return True
+
+    def place(self, requiredMemory):
+        """
+        Return the best free (node, gpu) with at least requiredMemory MiB and reserve it, None if none fits.
+        """
+        with self.lock:
+            free = self.table[(self.table["used"] < self.idleMemory) & (self.table["total"] >= requiredMemory)]
+            for node, gpu in zip(*[free.sort_values(["total", "gpu"])[column] for column in ("node", "gpu")]):
+                placement = (node, int(gpu))
+                if self.reserve(placement):
+                    return placement
+            return None
+
+    def request(self, job, callback):
+        """
+        Place job now if possible, otherwise queue it. callback(job) is called (in a worker thread)
+        once job.placement is set. Returns True if the job was placed straight away.
+        """
+        self.poll()
+        largest = self.table["total"].max() if len(self.table) > 0 else np.nan
+        if not pd.isna(largest) and job.requiredMemory > largest:
+            raise ValueError(f"the job needs about {job.requiredMemory} MiB of GPU memory, the largest GPU of the server has {int(largest)} MiB")
+        placement = self.place(job.requiredMemory)
+        if placement is not None:
+            job.placement = placement
+            threading.Thread(target=callback, args=(job,), daemon=True).start()
+            return True
+        with self.lock:
+            self.queue.append((job, callback))
+            self.start_worker()
+        return False
+
+    def start_worker(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        self.worker = threading.Thread(target=self.process_queue, daemon=True)
+        self.worker.start()
+
+    def process_queue(self):
+        """
+        Place the queued jobs in order as GPUs become free.
+        """
+        while True:
+            with self.lock: #Checked under the lock, as request queues a job under it
+                if len(self.queue) == 0:
+                    self.worker = None
+                    return
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                self.telemetry.log(f"\nCannot poll the GPUs: {e}\n")
+                continue
+            with self.lock:
+                while len(self.queue) > 0:
+                    job, callback = self.queue[0]
+                    placement = self.place(job.requiredMemory)
+                    if placement is None:
+                        break
+                    self.queue.popleft()
+                    job.placement = placement
+                    threading.Thread(target=callback, args=(job,), daemon=True).start()
+
+
+class LocalExecutor(SharedService):
+    """
+    Job queue of the local machine (no SSH, no PBS). At most maxJobs jobs run at the same time,
+    each one on its own GPU: CUDA_VISIBLE_DEVICES (and ALPHASUB_GPU, read by run_pred.sh) is set from
+    the GPUs seen by nvidia-smi that are idle and not given to another job of the queue.
+    gpus restricts the GPUs used (list of indexes), jobs without models run without GPU.
+    started(job) given with each job is called when its scripts are launched, done(job, returncode) when they end
+    (returncode is the error message when the job could not be launched).
+    Slots and GPUs are held with lock files in lockDir, so maxJobs and the GPUs are shared by all the
+    processes of the machine (panel serve --num-procs, command line), not counted per process.
+    """
+
+    def __init__(self, host=None, maxJobs=1, gpus=None, interval=5, idleMemory=120, lockDir="~/.alphasub/local_locks"):
+        SharedService.__init__(self, host)
+        self.maxJobs = max(1, maxJobs)
+        self.gpus = gpus
+        self.interval = interval # seconds between two checks of the running jobs
+        self.idleMemory = idleMemory # MiB, a GPU using less is free for a job of unknown size
+        self.lockDir = os.path.expanduser(lockDir)
+        self.queue = deque() # (job, done, started)
+        self.running = {} # workdir -> (job, done, process, gpu, lock files)
+        self.lock = threading.RLock()
+        self.worker = None
+
+    def submit(self, job, done, started=None):
+        with self.lock:
+            self.queue.append((job, done, started))
+            self.start_worker()
+
+    def gpu_rows(self):
+        """
+        nvidia-smi rows of the local GPUs the jobs can use (none without nvidia-smi).
+        """
+        try:
+            out = subprocess.run(NVIDIA_SMI_QUERY, shell=True, capture_output=True, text=True).stdout
+        except OSError:
+            out = ""
+        return [row for row in parse_nvidia_smi(out) if self.gpus is None or row["gpu"] in self.gpus]
+
+    def free_gpus(self, requiredMemory=0, rows=None):
+        """
+        Local GPUs not used by a running job with at least requiredMemory MiB free, smallest first.
+        Other processes may use the rest (a GPU driving the display uses a few hundred MiB),
+        without estimate (requiredMemory 0) the GPU must use less than idleMemory.
+        """
+        rows = self.gpu_rows() if rows is None else rows
+        used = set(gpu for job, done, process, gpu, locks in self.running.values())
+        fits = lambda row: row["total"] - row["used"] >= requiredMemory if requiredMemory > 0 else row["used"] < self.idleMemory
+        rows = [row for row in rows if row["gpu"] not in used and fits(row)]
+        return [row["gpu"] for row in sorted(rows, key=lambda row: (row["total"], row["gpu"]))]
+
+    def acquire(self, names):
+        """
+        Take the first free lock file of names (released when the file is closed, or when the process dies).
+        Returns (name, file) or (None, None) when all are held.
+        """
+        import fcntl
+        os.makedirs(self.lockDir, exist_ok=True)
+        for name in names:
+            f = open(os.path.join(self.lockDir, f"{name}.lock"), "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            return name, f
+        return None, None
+
+    def launch(self, job, gpu):
+        env = dict(os.environ)
+        env["CUDA_VISIBLE_DEVICES"] = "" if gpu is None else str(gpu)
+        if gpu is not None:
+            env["ALPHASUB_GPU"] = str(gpu)
+        command = " && ".join(f"bash {shlex.quote(script)}" for script in job.scripts)
+        with open(os.path.join(job.workdir, "alphasub_local.log"), "ab") as log:
+            return subprocess.Popen(["bash", "-c", command], cwd=job.workdir, env=env,
+                                    stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def step(self):
+        """
+        Reap the finished jobs, then start queued jobs in order while slots and GPUs are free.
+        A job no local GPU can hold (no GPU, or not enough memory) fails instead of blocking the queue.
+        """
+        finished = []
+        launched = []
+        with self.lock:
+            for workdir, (job, done, process, gpu, locks) in list(self.running.items()):
+                if process.poll() is not None:
+                    del self.running[workdir]
+                    for f in locks:
+                        f.close()
+                    finished.append((job, done, process.returncode))
+            while len(self.queue) > 0 and len(self.running) < self.maxJobs:
+                job, done, started = self.queue[0]
+                slot, slotLock = self.acquire([f"slot{i}" for i in range(self.maxJobs)])
+                if slot is None:
+                    break #Slots taken by the other processes
+                locks = [slotLock]
+                gpu = None
+                if job.doModels:
+                    rows = self.gpu_rows()
+                    if not any(row["total"] >= job.requiredMemory for row in rows):
+                        slotLock.close()
+                        self.queue.popleft()
+                        message = (f"No local GPU has {job.requiredMemory} MiB of memory" if len(rows) > 0
+                                   else "No local GPU found (nvidia-smi)")
+                        finished.append((job, done, message))
+                        continue
+                    gpus = {f"gpu{g}": g for g in self.free_gpus(job.requiredMemory, rows)}
+                    name, gpuLock = self.acquire(list(gpus))
+                    if name is None:
+                        slotLock.close()
+                        break
+                    gpu = gpus[name]
+                    locks.append(gpuLock)
+                self.queue.popleft()
+                job.placement = ("local", gpu) if gpu is not None else None
+                try:
+                    self.running[job.workdir] = (job, done, self.launch(job, gpu), gpu, locks)
+                    launched.append((job, started))
+                except OSError as e:
+                    for f in locks:
+                        f.close()
+                    finished.append((job, done, f"Cannot launch the scripts: {e}"))
+        for job, started in launched:
+            if started is not None:
+                started(job)
+        for job, done, returncode in finished:
+            done(job, returncode)
+
+    def start_worker(self):
+        """
+        Start the worker if there is none. Called with self.lock held.
+        """
+        if self.worker is not None and self.worker.is_alive():
+            return
+        def follow():
+            while True:
+                #Checked under the lock: a job submitted while the worker ends gets a new worker
+                with self.lock:
+                    if len(self.queue) == 0 and len(self.running) == 0:
+                        self.worker = None
+                        return
+                try:
+                    self.step()
+                except Exception as e:
+                    self.log(f"\nLocal job queue error: {e}\n")
+                time.sleep(self.interval)
+        self.worker = threading.Thread(target=follow, daemon=True)
+        self.worker.start()
+
+    def wait(self):
+        """
+        Block until every queued job has ended (command line: the queue lives in this process).
+        """
+        while True:
+            worker = self.worker
+            if worker is None or not worker.is_alive():
+                return
+            worker.join()
 
+    def stop(self):
+        """
+        Nothing to stop: the worker ends with the last job and the jobs keep running.
+        """
+        pass
 
 
 class Host():
@@ -43,7 +1254,9 @@ class Host():
     
     def __init__(self):
         self.sshconfig = os.path.expanduser("~/.ssh/config")
-        self.ssh = None
+        self.pool = get_shared("sshPool", SSHPool)
+        self.poolKey = None # Key of the connexion in the pool, set by connect()
+        self.connectTimeout = 30 # Seconds, a hung proxy or server fails instead of blocking the connexion
         self.node= None
         self.gpudf = None
         self.selectedgpu = None
@@ -51,6 +1264,36 @@ class Host():
         self.multiGPU = False
         self.parameters = {}
         self.isconnected = False
+        self.executor = "qsub"
+        self.local = False # Jobs run on this machine (no SSH), see LocalExecutor
+        self.maxLocalJobs = 1 # Jobs running at the same time on the local machine
+        self.localGPUs = None # GPUs used by the local jobs (None: all)
+        self.localExecutor = None
+        self.cpuQueue = "cryoem" # Queue for CPU only jobs (MSA search when stages are split)
+        self.gpuQueue = "cryoem"
+        self.gpuClasses = {} # GPU class -> memory (MiB), the smallest class large enough is requested to PBS
+        self.gpuResource = "gpu_model" # PBS resource holding the GPU class of a node
+        self.msaCacheDir = "$HOME/.alphasub/msa_cache" # MSA cache on the host
+        self.msaCacheSize = 50 # GB, least recently used MSAs are removed above this size
+        self.transferChannels = 4 # SFTP channels used at the same time to upload the inputs
+        # Settings of the active server: servers.json (apply_server_config), then the server tab of the GUI
+        self.hostWorkdir = "" # Working directory on the host
+        self.singularityImage = ""
+        self.databaseFolder = ""
+        self.paramsFolder = ""
+        self.compressTransfer = False # Inputs and results go through gzip compressed tar streams
+        self.gpu = 0 # GPU written in the scripts when no scheduler sets ALPHASUB_GPU
+        self.scheduler = None # GPUScheduler over all the nodes of the server, created at connexion
+        self.telemetry = None # GPUTelemetry of all the nodes of the server, created at connexion
+        self.telemetryListener = None
+        self.tracker = None # JobTracker of the server
+        self.sparklines = {}
+        self.doc = None # Bokeh document of the session, used to update widgets from threads
+        self.terminal = None # Without panels (command line) the terminal output goes to stderr
+        self.scrollback = 10000 # Lines kept by the terminal, the python side keeps at most maxTerminalChars
+        self.maxTerminalChars = 2000000
+        self.chunkSize = 32768 # Bytes read at once on SSH channels
+        self.pollDelay = 0.1 # Seconds between two reads when a channel has nothing to send
         
         
         
@@ -60,14 +1303,48 @@ class Host():
         
 
 
+    @property
+    def ssh(self):
+        """
+        SSH client drawn from the shared pool (reconnected if the transport was dropped).
+        """
+        if self.poolKey is None:
+            return None
+        return self.pool.get(self.poolKey, self.open_client)
+
+    def get_sftp(self):
+        if self.local:
+            return LocalSFTP()
+        return self.pool.get_sftp(self.poolKey, self.open_client)
+
+    def transfer(self):
+        """
+        Uploader of the job files to the host.
+        """
+        if self.local:
+            return LocalTransfer(self)
+        return SFTPTransfer(self, self.transferChannels, slots=self.pool.transfer_slots(self.poolKey))
+
     def connect(self):
         """
-        Main function for connexion.
+        Main function for connexion. The connexion is shared with the other jobs and sessions
+        using the same server, user and proxy. Nothing to open for the local machine.
+        """
+        if self.local:
+            self.poolKey = None
+            return None
+        self.poolKey = SSHPool.make_key(self.parameters)
+        return self.ssh
+
+    def open_client(self):
+        """
+        Open a new SSH connexion (called by the pool only).
         """
+        import paramiko
         ssh_config = paramiko.SSHConfig() # Loading config module
-        self.ssh = paramiko.SSHClient() # Loading SSHClient
-        self.ssh.load_system_host_keys() # load present host keys
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy()) # Ignore warning when it's the first time connecting
+        client = paramiko.SSHClient() # Loading SSHClient
+        client.load_system_host_keys() # load present host keys
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy()) # Ignore warning when it's the first time connecting
 
 
         if os.path.isfile(self.sshconfig): #If the SSH config file is present.
@@ -84,10 +1361,12 @@ class Host():
         
         if self.parameters["useProxy"] == True:
             sock = paramiko.ProxyCommand(proxycommand) #Configure the proxy.
-            self.ssh.connect(self.parameters['serverName'], username=self.parameters['user'], password=self.parameters['password'], sock=sock)
+            client.connect(self.parameters['serverName'], username=self.parameters['user'], password=self.parameters['password'], sock=sock,
+                           timeout=self.connectTimeout, banner_timeout=self.connectTimeout, auth_timeout=self.connectTimeout)
         else:
-            self.ssh.connect(self.parameters['serverName'], username=self.parameters['user'], password=self.parameters['password'])
-        self.sshChanel = self.ssh.invoke_shell()
+            client.connect(self.parameters['serverName'], username=self.parameters['user'], password=self.parameters['password'],
+                           timeout=self.connectTimeout, banner_timeout=self.connectTimeout, auth_timeout=self.connectTimeout)
+        return client
 
 
     def create_config_file(self):
@@ -143,30 +1422,19 @@ then
 fi
 """)
 
-    def check_gpu_usage(self):
-        nvidiasmi_command = "nvidia-smi --query-gpu=timestamp,name,temperature.gpu,utilization.gpu,utilization.memory,memory.total,memory.free,memory.used --format=csv"
+    def node_command(self, cmd, node=None):
+        """
+        On the I2BC cluster, commands about a node (GPU, page cache...) have to be run on the node itself.
+        """
+        node = self.node if node is None else node
         if self.parameters['serverName'].lower() == "cluster-i2bc":
-            fullcommand = f"ssh node{self.node} {nvidiasmi_command}"
-        else:
-            fullcommand = f"{nvidiasmi_command}"
-        ssh_stdin, ssh_stdout, ssh_stderr = self.ssh.exec_command(fullcommand)
-        results = ssh_stdout.read().decode()
-        csv = StringIO(results)
-        self.gpudf = pd.read_csv(csv)
-        self.gpudf["utilisation.gpu (%)"] = self.gpudf[' utilization.gpu [%]'].str.extract(r'(\d+)')
-        self.gpudf["utilisation.mem (%)"] = self.gpudf[' utilization.memory [%]'].str.extract(r'(\d+)')
-        self.gpudf["total memory (MiB)"] = self.gpudf[' memory.total [MiB]'].str.extract(r'(\d+)')
-        self.gpudf["Free memory (MiB)"] = self.gpudf[' memory.free [MiB]'].str.extract(r'(\d+)')
-        self.gpudf["Used Memory (MiB)"] = self.gpudf[' memory.used [MiB]'].str.extract(r'(\d+)')
-
-        self.gpudf["utilisation.gpu (%)"]  = self.gpudf["utilisation.gpu (%)"].astype(float)
-        self.gpudf["utilisation.mem (%)"]  = self.gpudf["utilisation.mem (%)"].astype(float)
-        self.gpudf["total memory (MiB)"]  = self.gpudf["total memory (MiB)"].astype(int)
-        self.gpudf["Free memory (MiB)"]  = self.gpudf["Free memory (MiB)"].astype(int)
-        self.gpudf["Used Memory (MiB)"]  = self.gpudf["Used Memory (MiB)"].astype(int)
-        
-        #self.gpudf = self.gpudf[[" name","utilisation.gpu (%)","utilisation.mem (%)", "total memory (MiB)","Free memory (MiB)","Used Memory (MiB)"]]
-        self.gpudf = self.gpudf[[" name", "total memory (MiB)", "Used Memory (MiB)"]]
+            return f"ssh node{node} {shlex.quote(cmd)}"
+        return cmd
+
+    def check_gpu_usage(self):
+        rows = parse_nvidia_smi(self.query(self.node_command(NVIDIA_SMI_QUERY)), self.node)
+        gpudf = pd.DataFrame(rows, columns=NVIDIA_SMI_COLUMNS).set_index("gpu")
+        self.gpudf = gpudf.rename(columns={"total": "total memory (MiB)", "used": "Used Memory (MiB)"})[["name", "total memory (MiB)", "Used Memory (MiB)"]]
         
         
     def update_parameters_tab(self, event):
@@ -191,6 +1459,9 @@ fi
 
         newparameters = {"serverName":serverName}
         newparameters["server"] = serverAddress
+        newparameters["executor"] = self.configJson[serverName].get("executor", "qsub")
+        self.apply_server_config(serverName)
+        self.compressTransferPanel.value = self.compressTransfer
 
 
         newparameters = add_in_dict(activeTab, newparameters)
@@ -201,9 +1472,75 @@ fi
 
             
         self.parameters = newparameters
+        #Values typed in the tab of the server
+        self.hostWorkdir = newparameters.get("workdir", self.hostWorkdir)
+        for attribute in ("singularityImage", "databaseFolder", "paramsFolder"):
+            setattr(self, attribute, newparameters.get(attribute, getattr(self, attribute)))
+        if newparameters.get("GPUID") is not None:
+            self.gpu = newparameters["GPUID"]
+
+    def tab_setting_changed(self, server, attribute, event):
+        #Only the tab of the active server sets the host settings
+        if self.hostTab._names[self.hostTab.active] == server:
+            setattr(self, attribute, event.new)
 
 
         
+    def apply_server_config(self, serverName):
+        """
+        Settings of servers.json that are not in the tabs.
+        """
+        config = self.configJson[serverName]
+        self.executor = config.get("executor", "qsub")
+        #No server address: the jobs run on this machine
+        self.local = config["server"] in ("", "localhost", "127.0.0.1")
+        self.maxLocalJobs = config.get("maxJobs", config.get("NGPU", 1))
+        self.localGPUs = config.get("gpus", None)
+        self.idleMemory = config.get("idleMemory", 120) # MiB, see LocalExecutor.free_gpus
+        self.cpuQueue = config.get("cpuQueue", "cryoem")
+        self.gpuQueue = config.get("gpuQueue", "cryoem")
+        self.gpuClasses = config.get("gpuClasses", {})
+        self.gpuResource = config.get("gpuResource", "gpu_model")
+        self.msaCacheDir = config.get("msaCacheDir", "$HOME/.alphasub/msa_cache")
+        self.msaCacheSize = config.get("msaCacheSize", 50)
+        self.transferChannels = config.get("transferChannels", 4)
+        self.singularityImage = config.get("singularityImage", "")
+        self.databaseFolder = config.get("databaseFolder", "")
+        self.paramsFolder = config.get("paramsFolder", "")
+        self.compressTransfer = config.get("compressTransfer", self.compressTransfer)
+
+    def init_headless(self, serverName, workdir="", user=None, password=None, gpu=0):
+        """
+        Configure the host from servers.json without panels nor session (Python API, command line):
+        the values of the server tab are read from the file, no GPU telemetry is collected
+        (PBS or the local job queue place the jobs).
+        """
+        if serverName not in self.configJson:
+            raise ValueError(f"Unknown server {serverName}, known servers: {', '.join(self.configJson)}")
+        config = self.configJson[serverName]
+        self.apply_server_config(serverName)
+        self.parameters = {"serverName": serverName,
+                           "server": config["server"],
+                           "executor": self.executor,
+                           "user": config.get("user", "") if user is None else user,
+                           "password": password,
+                           "useProxy": config.get("passerelle", "") != "",
+                           "proxyAddress": config.get("passerelle", ""),
+                           "workdir": workdir,
+                           }
+        self.hostWorkdir = workdir
+        self.gpu = gpu
+        nodes = config.get("nodes", [])
+        self.node = int(nodes[0].split()[0]) if len(nodes) > 0 else None
+        self.define_PBSlines()
+        self.connect()
+        self.tracker = JobTracker(self)
+        if self.local:
+            self.localExecutor = get_shared(("localExecutor", serverName), lambda: LocalExecutor(self, self.maxLocalJobs, self.localGPUs, idleMemory=self.idleMemory))
+            self.localExecutor.attach(self)
+        self.isconnected = True
+        return self
+
     def select_gpu(self):
         freegpu = list(self.gpudf.query("`Used Memory (MiB)` < 120 ").index)
         if len(freegpu) == 0:
@@ -220,24 +1557,88 @@ fi
             GPUdfPanel.style.apply(lambda x: ['background: lightgreen' if x.name in [self.selectedgpu] else '' for i in x], axis=1)
             self.hostTab[self.hostTab.active].insert(index, pn.Card(GPUdfPanel, name="dataFrameGPUCARD", title="GPU INFO"))
         else:
-            self.hostTab[self.hostTab.active].pop(index)
-
-            GPUdfPanel = pn.widgets.Tabulator(self.gpudf, name="dataFrameGPU")
-            GPUdfPanel.style.apply(lambda x: ['background: lightgreen' if x.name in [self.selectedgpu] else '' for i in x], axis=1)
-            self.hostTab[self.hostTab.active].insert(index, pn.Card(GPUdfPanel, name="dataFrameGPUCARD", title="GPU INFO"))
+            #Update the table in place
+            GPUdfPanel = dfGPU.objects[0]
+            GPUdfPanel.value = self.gpudf
 
         gpuWidget = self.find_object_in_tab(currentTab, "GPUID")
-
-        gpuWidget.value=self.selectedgpu
+        if gpuWidget is not None: #No GPU choice on single GPU servers
+            gpuWidget.value=self.selectedgpu
 
         return None
 
         
         
 
+    def database_files(self, patterns):
+        return " ".join(f"{self.databaseFolder}/{pattern}" for pattern in patterns)
+
+    def check_database_cache(self, patterns):
+        """
+        Return the fraction (0-1) of the database files resident in the page cache of the node,
+        None if neither vmtouch nor fincore are available.
+        """
+        out = self.query(self.node_command(database_resident_command(self.database_files(patterns)))).strip()
+        if out == "":
+            return None
+        return int(out.splitlines()[-1]) / 100
+
+    def preload_database(self, patterns):
+        """
+        Launch a job reading the database files into the page cache of the node, so the
+        MMseqs2 searches can use --db-load-mode 2 (mmap) without reading the disk.
+        """
+        host = f":host=node{self.node}" if self.node is not None else ""
+        script = f"""#!/bin/bash
+#PBS -l select=1:ncpus=1{host}
+#PBS -q {self.cpuQueue}
+{database_preload_command(self.database_files(patterns))}
+"""
+        self.query("mkdir -p $HOME/.alphasub")
+        home = self.query("echo $HOME").strip()
+        self.get_sftp().putfo(BytesIO(script.encode()), f"{home}/.alphasub/preload_db.sh")
+        if self.executor == "bash":
+            return self.run_command("nohup bash preload_db.sh > preload_db.log 2>&1 &", cd=f"{home}/.alphasub")
+        return self.run_command(f"{self.executor} preload_db.sh", cd=f"{home}/.alphasub")
+
     def define_PBSlines(self):
-        self.PBSlines = f"""#PBS -l select=1:ncpus=8:host=node{self.node}:ngpus=1
-#PBS -q cryoem"""
+        self.PBSlines = self.pbs_lines()
+
+    def pbs_lines(self, pinNode=True, stage="models", ncpus=16, mem=64, resources=None):
+        """
+        PBS resource lines. Without pinNode, PBS is free to use any node with a free GPU (batch mode).
+        The search stage only needs CPUs and memory (ncpus, mem in GB) and goes to the CPU queue.
+        With resources (see estimate_resources) the GPU jobs ask for the estimated memory and walltime,
+        and for the smallest GPU class large enough when they are not pinned to a node.
+        """
+        if stage == "search":
+            return f"""#PBS -l select=1:ncpus={ncpus}:mem={mem}gb
+#PBS -q {self.cpuQueue}"""
+        if resources is None:
+            return f"""#PBS -l {self.pbs_select(self.node if pinNode else None)}
+#PBS -q {self.gpuQueue}"""
+        node = self.node if pinNode else None
+        gpuClass = None if pinNode else self.pick_gpu_class(resources["gpuMemory"])
+        return f"""#PBS -l {self.pbs_select(node, mem=resources["mem"], gpuClass=gpuClass)}
+#PBS -l walltime={resources["walltime"]}
+#PBS -q {self.gpuQueue}"""
+
+    def pbs_select(self, node=None, mem=None, gpuClass=None):
+        host = f":host=node{node}" if node is not None else ""
+        memory = f":mem={mem}gb" if mem is not None else ""
+        model = f":{self.gpuResource}={gpuClass}" if gpuClass is not None else ""
+        return f"select=1:ncpus=8{memory}{host}:ngpus=1{model}"
+
+    def pick_gpu_class(self, requiredMemory):
+        """
+        Smallest GPU class of servers.json ("gpuClasses": {"name": memory in MiB}) with enough memory,
+        the largest one if none is large enough, None if no class is defined.
+        """
+        if len(self.gpuClasses) == 0:
+            return None
+        classes = sorted(self.gpuClasses.items(), key=lambda item: item[1])
+        fitting = [name for name, memory in classes if memory >= requiredMemory]
+        return fitting[0] if len(fitting) > 0 else classes[-1][0]
 
 
     def find_object_in_tab(self, panel, name):
@@ -272,15 +1673,18 @@ fi
 
         selectedTab = self.hostTab._names[self.hostTab.active]
 
-        #1. Create host config file 
-        self.create_config_file()
+        if not self.local:
+            #1. Create host config file
+            self.create_config_file()
 
-        #2 Connect to SSH to the I2BC cluster
-        self.connect()
-        self.write_terminal("\nConnected\n")
+            #2 Connect to SSH to the I2BC cluster
+            self.connect()
+            self.write_terminal("\nConnected\n")
 
-        #3. prepare connexion to node
-        self.add_key_in_authorized_keys()
+            #3. prepare connexion to node
+            self.add_key_in_authorized_keys()
+        else:
+            self.connect()
 
         #4. check GPU usage
         self.check_gpu_usage()
@@ -288,6 +1692,7 @@ fi
         #4. Find available GPU
         self.select_gpu()
         self.define_PBSlines()
+        self.init_scheduler()
         self.hostTab.loading=False
 
         
@@ -301,6 +1706,70 @@ fi
         
         #self.p1.append(self.GPUdfPanel)
     
+    def init_scheduler(self):
+        """
+        Scheduler over every node listed in servers.json for this server (or the server itself).
+        Telemetry, scheduler and job tracker are shared by all the sessions using the same server.
+        """
+        self.detach_services()
+        server = self.parameters['serverName']
+        labels = self.configJson[server].get("nodes", [])
+        nodes = [int(label.split()[0]) for label in labels] if len(labels) > 0 else [self.node]
+        self.telemetry = get_shared(("telemetry", server), lambda: GPUTelemetry(self, nodes))
+        self.telemetry.attach(self)
+        self.telemetryListener = lambda table: run_in_ui(self.doc, self.update_telemetry_view, table)
+        self.telemetry.listeners.append(self.telemetryListener)
+        self.telemetry.start()
+        self.scheduler = get_shared(("scheduler", server), lambda: GPUScheduler(self.telemetry, reservationDir=os.path.join("~/.alphasub/gpu_reservations", server)))
+        #One tracker per account: its commands run with the connexion of the attached sessions
+        self.tracker = get_shared(("jobTracker",) + SSHPool.make_key(self.parameters), JobTracker)
+        self.tracker.attach(self)
+        if self.local:
+            self.localExecutor = get_shared(("localExecutor", server), lambda: LocalExecutor(self, self.maxLocalJobs, self.localGPUs, idleMemory=self.idleMemory))
+            self.localExecutor.attach(self)
+
+    def detach_services(self):
+        """
+        Stop using the shared services (new connexion or end of the session).
+        They stop polling when no session uses them anymore.
+        """
+        if self.telemetry is not None:
+            if self.telemetryListener in self.telemetry.listeners:
+                self.telemetry.listeners.remove(self.telemetryListener)
+            if self.telemetry.detach(self) == 0:
+                self.telemetry.stop()
+        if self.tracker is not None and self.tracker.detach(self) == 0:
+            self.tracker.stop()
+        if self.localExecutor is not None:
+            self.localExecutor.detach(self)
+
+    def update_telemetry_view(self, table):
+        """
+        Update the GPU card in place: changed cells are patched, sparklines get the new samples.
+        """
+        old = self.telemetryTable.value
+        if len(old) == len(table) and list(old["node"]) == list(table["node"]) and list(old["gpu"]) == list(table["gpu"]):
+            patch = {}
+            for column in ["temperature", "util", "memUtil", "used", "free"]:
+                changes = [(i, value) for i, (value, previous) in enumerate(zip(table[column], old[column])) if value != previous and not (pd.isna(value) and pd.isna(previous))]
+                if len(changes) > 0:
+                    patch[column] = changes
+            if len(patch) > 0:
+                self.telemetryTable.patch(patch)
+        else:
+            self.telemetryTable.value = table
+
+        for node, gpu, util in zip(table["node"], table["gpu"], table["util"]):
+            key = (node, gpu)
+            if key not in self.sparklines:
+                samples = list(self.telemetry.history.get(key, []))
+                self.sparklines[key] = pn.indicators.Trend(title=f"node{node} GPU{gpu}" if node is not None else f"GPU{gpu}",
+                                                           data={"x": [t for t, u, m in samples], "y": [u for t, u, m in samples]},
+                                                           plot_type="area", height=90, width=180, sizing_mode="fixed")
+                self.sparklinesLayout.append(self.sparklines[key])
+            else:
+                self.sparklines[key].stream({"x": [time.time()], "y": [util]}, rollover=self.telemetry.historySize)
+
     def create_tabs_from_config(self):
 
         #Function for 2 lines because i'm lazy
@@ -309,6 +1778,7 @@ fi
             value= param[label]
             temp = panel.clone(name=label)
             temp.value = value            
+            temp.param.watch(partial(self.tab_setting_changed, server, label), "value")
 
             col.append(temp)
 
@@ -328,29 +1798,33 @@ fi
             col.append(self.passwordPanel.clone(name="password"))
             col.append(self.userPanel.clone(name="user", value=params["user"]))
 
-            col.append(self.hostWorkdir.clone(name="workdir"))
+            workdirPanel = self.hostWorkdirPanel.clone(name="workdir")
+            workdirPanel.param.watch(partial(self.tab_setting_changed, server, "hostWorkdir"), "value")
+            col.append(workdirPanel)
+            gpuPanel = pn.widgets.Select(name="GPUID", options=list(range(params["NGPU"])))
+            gpuPanel.param.watch(partial(self.tab_setting_changed, server, "gpu"), "value")
             if "nodes" in params:
                 self.nodePanel.options = params["nodes"]
                 if params["NGPU"] > 1 :
                     col.append(pn.Row(
                         self.nodePanel.clone(name="Node"), 
-                        pn.widgets.Select(name="GPUID", options=list(range(params["NGPU"])))))
+                        gpuPanel))
             else:
                 if params["NGPU"] > 1:
                 #Adding choice of GPU
-                    col.append(pn.widgets.Select(name="GPUID", options=list(range(params["NGPU"]))))
+                    col.append(gpuPanel)
 
 
-            set_value_and_add(col, self.singularityImage, params, "singularityImage")
-            set_value_and_add(col, self.databaseFolder, params, "databaseFolder")
-            set_value_and_add(col, self.paramsFolder, params, "paramsFolder")
+            set_value_and_add(col, self.singularityImagePanel, params, "singularityImage")
+            set_value_and_add(col, self.databaseFolderPanel, params, "databaseFolder")
+            set_value_and_add(col, self.paramsFolderPanel, params, "paramsFolder")
             #if params["multipleGPU"] == True:
             #    col.append(self.accordeonDataFrame.clone(name="dataFrameCard"))
             #col.append(sqelf.gpu)
 
-            if str(server) != "local":
-                col.append(self.RUNBUTTON)
-                col.append(pn.Row(pn.widgets.StaticText(value="Connexion Statut"), self.statusPanel.clone(name="status")),)
+            #The local machine is "connected" too: no SSH, the jobs go to the LocalExecutor
+            col.append(self.RUNBUTTON)
+            col.append(pn.Row(pn.widgets.StaticText(value="Connexion Statut"), self.statusPanel.clone(name="status")),)
 
             tabs.append(col)
 
@@ -375,6 +1849,7 @@ fi
                         "paramsFolder": "",
                         "executor": "bash",
                         "NGPU":1,
+                        "maxJobs":1,
                             }
                         }
             with open(json_path,'w') as json_file:
@@ -389,24 +1864,34 @@ fi
 
 
     def init_panels(self):
+        self.doc = pn.state.curdoc
         #GENERAL
         self.passwordPanel = pn.widgets.PasswordInput(name="Password",placeholder="Password (not mandatory if ssh configured)")
         self.userPanel = pn.widgets.TextInput(name="Username",placeholder="Username")
         self.useProxyPanel = pn.widgets.Toggle(name="Use passerelle?",button_type="primary", value=True)
         self.statusPanel = pn.indicators.BooleanStatus(value=False, color="success")
         self.RUNBUTTON = pn.widgets.Button(name="Connection", button_type="primary")
-        self.singularityImage = pn.widgets.TextInput(name="Singularity image", placeholder="Path to Singularity Image", value="/data/work/I2BC/thibault.tubiana/alphafold/container/colabfold280422.sif")
-        self.databaseFolder = pn.widgets.TextInput(name="Database location", placeholder="Path to database folder", value="/data/work/I2BC/pa.charbit/colabfold/database/uniref30_2103")
-        self.paramsFolder = pn.widgets.TextInput(name="Database location", placeholder="Path to database folder", value="/data/work/I2BC/thibault.tubiana/alphafold/params")
-        self.hostWorkdir = pn.widgets.TextInput(name="Host WORKDIR", placeholder="Path to host workdir", value="/home/thibault.tubiana/work/alphasub/test")
+        #The clones in the server tabs write to the host settings (see tab_setting_changed)
+        self.singularityImagePanel = pn.widgets.TextInput(name="Singularity image", placeholder="Path to Singularity Image", value="/data/work/I2BC/thibault.tubiana/alphafold/container/colabfold280422.sif")
+        self.databaseFolderPanel = pn.widgets.TextInput(name="Database location", placeholder="Path to database folder", value="/data/work/I2BC/pa.charbit/colabfold/database/uniref30_2103")
+        self.paramsFolderPanel = pn.widgets.TextInput(name="Parameters location", placeholder="Path to AlphaFold parameters folder", value="/data/work/I2BC/thibault.tubiana/alphafold/params")
+        self.hostWorkdirPanel = pn.widgets.TextInput(name="Host WORKDIR", placeholder="Path to host workdir", value="/home/thibault.tubiana/work/alphasub/test")
+        self.hostWorkdir = self.hostWorkdirPanel.value
+        self.compressTransferPanel = pn.widgets.Checkbox(name="Compress transfers (slow links, passerelle)", value=self.compressTransfer)
+        self.compressTransferPanel.param.watch(lambda event: setattr(self, "compressTransfer", event.new), "value")
         
 
         #ClusterI2BC Only
         self.nodePanel = pn.widgets.Select(name="Node", options=["38 (GTX1080Ti)","39 (RTX2080TI"])
-        self.gpuPanel  = pn.widgets.Select(name = "GPUID", options=list(range(8)))       
 
         #    table with GPU
         self.GPUdfPanel = pn.widgets.Tabulator(name="gpuDfWidget",sizing_mode="stretch_width", max_width=385)
+        #    state of all GPUs of all nodes (GPUTelemetry)
+        self.telemetryTable = pn.widgets.Tabulator(pd.DataFrame(columns=NVIDIA_SMI_COLUMNS),
+                                                   name="telemetryTable", disabled=True, show_index=False)
+        self.sparklinesLayout = pn.Row(sizing_mode="stretch_width")
+        self.telemetryCard = pn.Card(self.telemetryTable, pn.pane.Markdown("GPU utilisation (%)"), self.sparklinesLayout,
+                                     title="GPUs of all nodes", collapsible=False)
         #self.accordeonDataFrame = pn.Card(self.GPUdfPanel, name='gpuDfCard', title="GPU Information", collapsed=True, sizing_mode='stretch_height', max_width=385)
 
 
@@ -421,7 +1906,7 @@ fi
         
         self.terminal = pn.widgets.Terminal(
     "This terminal will contain output from Alphafold Jobs",
-    options={"cursorBlink": True},
+    options={"cursorBlink": True, "scrollback": self.scrollback},
     sizing_mode='stretch_height'
 )
         self.terminalLayout = pn.Card(self.terminal, title="Terminal", collapsible=False)
@@ -431,19 +1916,85 @@ fi
 
 
     def write_terminal(self, str):
+        run_in_ui(self.doc, self._write_terminal, str)
+
+    def _write_terminal(self, str):
+        if self.terminal is None:
+            sys.stderr.write(str) #stdout is left to the results of the command line
+            return
         self.terminal.write(str)
+        #Terminal.output keeps everything ever written. It is not synced with the browser
+        #(xterm keeps its own scrollback) so it can be trimmed silently.
+        if len(self.terminal.output) > self.maxTerminalChars:
+            with param.discard_events(self.terminal):
+                self.terminal.output = self.terminal.output[-self.maxTerminalChars:]
 
     def run_command(self, cmd, cd=None):
+        """
+        Run a command on the host and write its output in the terminal while it runs.
+        stdout and stderr are read in the same loop, so they are interleaved in arrival order.
+        Returns the exit status.
+        """
         if cd != None:
             cmd = f"cd {cd}; {cmd}"
-
-
+        if self.local:
+            return self.run_local_command(cmd)
+
+        channel = self.ssh.get_transport().open_session()
+        channel.exec_command(cmd)
+        channel.setblocking(0)
+        #Incremental decoders, a chunk can end in the middle of an UTF-8 character.
+        outDecoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        errDecoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        while True:
+            received = False
+            if channel.recv_ready():
+                self.write_terminal(outDecoder.decode(channel.recv(self.chunkSize)))
+                received = True
+            if channel.recv_stderr_ready():
+                self.write_terminal(errDecoder.decode(channel.recv_stderr(self.chunkSize)))
+                received = True
+            if not received:
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                time.sleep(self.pollDelay)
+
+        tail = outDecoder.decode(b"", final=True) + errDecoder.decode(b"", final=True)
+        if tail:
+            self.write_terminal(tail)
+        status = channel.recv_exit_status()
+        channel.close()
+        return status
+
+    def run_local_command(self, cmd):
+        """
+        run_command on the local machine (stderr is merged in stdout).
+        """
+        process = subprocess.Popen(["bash", "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = os.read(process.stdout.fileno(), self.chunkSize)
+            if chunk == b"":
+                break
+            self.write_terminal(decoder.decode(chunk))
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            self.write_terminal(tail)
+        process.stdout.close()
+        return process.wait()
+
+    def query(self, cmd):
+        """
+        Run a command without writing in the terminal and return its standard output.
+        Used for polling (sentinel files, job ids...).
+        """
+        if self.local:
+            return subprocess.run(["bash", "-c", cmd], capture_output=True).stdout.decode(errors="replace")
         stdin, stdout, stderr = self.ssh.exec_command(cmd)
-
         out = stdout.read().decode()
-        err = stderr.read().decode()
-        self.terminal.write(out+"\n"+err)
-        return stdout.channel.recv_exit_status()        
+        stdout.channel.recv_exit_status()
+        return out
 
 
     def update_parameter_and_run(self, event):
@@ -461,20 +2012,658 @@ fi
         
 
 
-class Alphafold():
+class JobSpec():
     """
-    Class for all parameters for alphafold.
-    Underlines respects the PARAM methodology to instance parameters.
+    Parameters of a prediction, without any widget. The GUI builds one from its widgets (Alphafold.job_spec),
+    scripts and pipelines build them directly (see Submitter and the command line at the end of this file).
+    The inputs are query (sequence(s), with or without fasta headers), fasta (content of a fasta file,
+    split in chunks of chunkSize sequences with batch) or msas (list of (name, A3M content in bytes)).
     """
+    DEFAULTS = {"doAlignment": True,
+                "doModels": True,
+                "modelVersion": "auto",
+                "nmodels": 5,
+                "numRecycle": 3,
+                "useAmber": True,
+                "useGpuAmber": True,
+                "nmer": 1,
+                "sensitivity": 8,
+                "db1": "uniref30_2103_db",
+                "useEnv": False,
+                "useTemplate": False,
+                "filter": True,
+                "expandEval": "inf",
+                "alignEval": 10,
+                "diff": False,
+                "qsc": -20,
+                "maxAccept": 10,
+                "dbLoadMode": "auto",
+                "splitStages": False,
+                "searchNcpus": 16,
+                "searchMem": 64,
+                "useMsaCache": True,
+                "autoPlace": False,
+                "batch": False,
+                "chunkSize": 10,
+                }
+
+    def __init__(self, jobname, workdir, query="", fasta=None, msas=None, **parameters):
+        self.jobname = jobname
+        self.workdir = workdir
+        self.query = query
+        self.fasta = fasta
+        self.msas = msas if msas is not None else []
+        for name, value in self.DEFAULTS.items():
+            setattr(self, name, value)
+        for name, value in parameters.items():
+            if name not in self.DEFAULTS:
+                raise ValueError(f"Unknown job parameter {name}")
+            setattr(self, name, value)
+
+    @property
+    def mode(self):
+        if len(self.msas) > 0:
+            return "a3m"
+        return "fasta" if self.fasta is not None else "query"
+
+    def parameters(self):
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+    def input_files(self):
+        """
+        List of (name, content) of the inputs (fasta or A3M files).
+        """
+        if self.mode == "query":
+            content = self.query if self.query.startswith(">") else f">{self.jobname}\n{self.query}"
+            return [(f"{self.jobname}.fasta", content.encode())]
+        elif self.mode == "fasta":
+            return [(self.jobname+".fasta", self.fasta.encode())]
+        return list(self.msas)
 
+    def database_patterns(self):
+        """
+        Files of the databases used by the search (relative to the database folder).
+        """
+        patterns = [f"{self.db1}*"]
+        if self.useEnv:
+            patterns.append("colabfold_envdb_202108_db*")
+        return patterns
 
+    def msa_search_parameters(self):
+        """
+        Parameters changing the result of colabfold_search (part of the MSA cache key).
+        """
+        return {"sensitivity": self.sensitivity,
+                "db1": self.db1,
+                "use_env": self.useEnv,
+                "use_template": self.useTemplate,
+                "filter": self.filter,
+                "expand_eval": self.expandEval,
+                "align_eval": self.alignEval,
+                "diff": self.diff,
+                "qsc": self.qsc,
+                "max_accept": self.maxAccept,
+                }
+
+
+class Submitter():
+    """
+    Script generation and submission of JobSpec on a Host, used by the GUI (Alphafold)
+    and without any widget by the Python API and the command line.
+    listeners are called with a job every time it changes stage.
+    """
+
+    def __init__(self, host):
+        self.HOST = host
+        self.listeners = []
+        self.validationPoolSize = 1000000 # Inputs smaller than this (bytes) are checked without process pool
+        self.warmThreshold = 90 # % of the database in the page cache to use mmap in auto mode
+
+    def set_stage(self, job, stage, message=""):
+        job.set_stage(stage, message)
+        if job.batch is not None and stage not in ("uploading", "submitted"):
+            try:
+                job.batch.save(self.HOST.get_sftp())
+            except Exception as e:
+                self.HOST.write_terminal(f"\nCannot update the manifest of {job.batch.jobname}: {e}\n")
+        for listener in list(self.listeners):
+            listener(job)
+
+    def validate(self, spec):
+        """
+        Parse and check all the inputs (see alphasub_a3m.validate), in a process pool when they are big.
+        """
+        files = spec.input_files()
+        if sum(len(content) for name, content in files) < self.validationPoolSize:
+            return [alphasub_a3m.validate(name, content) for name, content in files]
+        with process_pool(min(len(files), os.cpu_count() or 1)) as pool:
+            return list(pool.map(alphasub_a3m.validate, [name for name, content in files], [content for name, content in files]))
+
+    def total_residues(self, spec, stats):
+        """
+        Number of residues of the largest prediction of the job (all chains, times the number of oligomers).
+        For A3M of complexes the chain lengths and cardinalities of the first line are used.
+        """
+        residues = []
+        for entry in stats:
+            if entry["kind"] == "a3m" and len(entry["chains"]) > 1:
+                residues.append(sum(length * n for length, n in zip(entry["chains"], entry["cardinality"])))
+            else:
+                residues += [length * spec.nmer for length in (entry["lengths"] or [entry["queryLength"]])]
+        return max(residues, default=0)
+
+    def msa_depth(self, stats):
+        """
+        Largest number of sequences of the A3M inputs, None when the MSAs are still to be searched.
+        """
+        depths = [entry["depth"] for entry in stats if entry["kind"] == "a3m"]
+        return max(depths) if len(depths) > 0 else None
+
+    def estimate_job_resources(self, spec, stats, residues=None):
+        """
+        Resources of a job predicting structures of the given sizes (default: the inputs, see total_residues).
+        """
+        if residues is None:
+            residues = [self.total_residues(spec, stats)]
+        split = spec.splitStages and spec.doAlignment
+        resources = estimate_resources(residues,
+                                       nmodels=spec.nmodels,
+                                       recycles=spec.numRecycle,
+                                       relax=spec.useAmber,
+                                       gpuRelax=spec.useGpuAmber,
+                                       search=spec.doAlignment and not split,
+                                       depth=self.msa_depth(stats))
+        if spec.doAlignment and not split:
+            resources["mem"] = max(resources["mem"], spec.searchMem) # The search runs in the same job
+        return resources
+
+    def build_scripts(self, spec, jobname, workdir, pinNode=True, gpuIndex=None, resources=None):
+        """
+        Return the list of (script name, script) to launch in order.
+        When stages are split, run_search.sh is a CPU only job and run_pred.sh (models) waits for it.
+        resources (see estimate_job_resources) sets the memory, walltime and GPU class of the PBS lines.
+        """
+        if resources is not None and spec.doModels:
+            pbsLines = self.HOST.pbs_lines(pinNode=pinNode, resources=resources)
+        else:
+            pbsLines = None if pinNode else self.HOST.pbs_lines(pinNode=False)
+        if spec.splitStages and spec.doAlignment and spec.doModels:
+            searchLines = self.HOST.pbs_lines(stage="search", ncpus=spec.searchNcpus, mem=spec.searchMem)
+            return [("run_search.sh", self.generate_script(spec, jobname, workdir, searchLines, gpuIndex, stage="search")),
+                    ("run_pred.sh", self.generate_script(spec, jobname, workdir, pbsLines, gpuIndex, stage="models")),
+                    ]
+        return [("run_pred.sh", self.generate_script(spec, jobname, workdir, pbsLines, gpuIndex))]
+
+    def helper_files(self):
+        """
+        Helpers called by the scripts on the host (see alphasub_a3m.py).
+        """
+        with open(A3M_HELPER, "rb") as f:
+            return [(A3M_HELPER_NAME, f.read())]
+
+    def collect_input_files(self, spec):
+        """
+        Return the list of (relative path, content) of the inputs to upload in the host workdir.
+        """
+        files = []
+        if spec.mode in ("query", "fasta"):
+            name, content = spec.input_files()[0]
+            files.append((name, content))
+            files += self.msa_cache_files(spec, parse_fasta(content.decode()))
+        else:
+            for name, content in spec.msas:
+                name = name.replace(" ","_").replace("'","")
+                files.append((f"msas/{name}", content))
+        return files
+
+    def msa_cache_files(self, spec, entries):
+        """
+        msa_cache.tsv (key, name, sequence for every query) read by run_pred.sh to look up the MSA cache.
+        """
+        if not spec.useMsaCache or not spec.doAlignment or len(entries) == 0:
+            return []
+        parameters = spec.msa_search_parameters()
+        lines = []
+        for name, seq in entries:
+            name = name.split("\t")[0].strip() #Same name as the renamed a3m (see generate_script)
+            lines.append(f"{msa_cache_key(seq, parameters)}\t{name}\t{''.join(seq.split())}\n")
+        return [("msa_cache.tsv", "".join(lines).encode())]
+
+    def prepare(self, spec, stats=None):
+        """
+        Jobs and files of a JobSpec: returns (manifest, [(JobStatus, [(relative path, content)])]).
+        In batch mode the fasta file is split in chunks of chunkSize sequences, every chunk is an
+        independent job in its own sub-directory of the workdir, not pinned to a node (manifest is a BatchManifest).
+        Otherwise manifest is None and there is one job.
+        """
+        stats = self.validate(spec) if stats is None else stats
+        server = self.HOST.parameters.get("serverName", "")
+        if spec.mode == "fasta" and spec.batch:
+            manifest = BatchManifest(spec.jobname, spec.workdir, spec.chunkSize)
+            chunks = []
+            for i, chunk in enumerate(chunk_list(parse_fasta(spec.fasta), spec.chunkSize)):
+                chunkName = f"{spec.jobname}_chunk{i:03d}"
+                chunkDir = f"{spec.workdir}/{chunkName}"
+                resources = self.estimate_job_resources(spec, stats, [len(seq.replace(":", "")) * spec.nmer for name, seq in chunk])
+                scripts = self.build_scripts(spec, chunkName, chunkDir, pinNode=False, gpuIndex="${CUDA_VISIBLE_DEVICES}", resources=resources)
+                content = "".join(f">{name}\n{seq}\n" for name, seq in chunk)
+                files = [(name, script.encode()) for name, script in scripts] + [(f"{chunkName}.fasta", content.encode())]
+                files += self.helper_files() + self.msa_cache_files(spec, chunk)
+                job = JobStatus(chunkName, chunkDir, server, doModels=spec.doModels)
+                job.scripts = [name for name, script in scripts]
+                job.resources = resources
+                job.requiredMemory = resources["gpuMemory"]
+                manifest.add(job, [name for name, seq in chunk])
+                chunks.append((job, files))
+            return manifest, chunks
+
+        resources = self.estimate_job_resources(spec, stats)
+        scripts = self.build_scripts(spec, spec.jobname, spec.workdir, resources=resources)
+        files = [(name, script.encode()) for name, script in scripts] + self.helper_files() + self.collect_input_files(spec)
+        job = JobStatus(spec.jobname, spec.workdir, server, doModels=spec.doModels)
+        job.scripts = [name for name, script in scripts]
+        job.resources = resources
+        job.requiredMemory = resources["gpuMemory"]
+        return None, [(job, files)]
+
+    def report_msa_cache(self, job, content):
+        """
+        Count in one command the queries of a job already in the MSA cache and write it in the terminal.
+        """
+        keys = [line.split("\t")[0] for line in content.decode().splitlines() if line != ""]
+        names = " ".join(f"{key}.a3m" for key in keys)
+        out = self.HOST.query(f"cd {self.HOST.msaCacheDir} 2>/dev/null && ls {names} 2>/dev/null | wc -l")
+        hits = int(out.strip() or 0)
+        self.HOST.write_terminal(f"\nMSA cache for {job.jobname}: {hits} hit(s), {len(keys)-hits} miss(es)\n")
+
+    def submit_job(self, job, files, launch, notify=None):
+        """
+        Upload the inputs and launch the scripts. notify(kind, message, duration) reports the outcome
+        (see Alphafold.notifier). Returns True if the job was submitted.
+        """
+        notify = notify if notify is not None else (lambda kind, message, duration=3000: None)
+        try:
+            self.set_stage(job, "uploading")
+            #Check Connectivity:
+            outcode = self.HOST.run_command(f'mkdir -p {job.workdir}/msas')
+            if outcode != 0:
+                self.set_stage(job, "failed", "Cannot create output directory")
+                notify("error", "Cannot create output directory. Please check terminal output", 0)
+                return False
+
+            transfer = self.HOST.transfer()
+            if self.HOST.compressTransfer and not self.HOST.local:
+                #Inputs are sent in one archive, unpacked by the script (scripts stay plain for qsub)
+                inputs = [(name, content) for name, content in files if name not in job.scripts]
+                report = transfer.upload(job.workdir, [(name, content) for name, content in files if name in job.scripts] + [("inputs.tar.gz", pack_files(inputs))])
+            else:
+                report = transfer.upload(job.workdir, files)
+            self.HOST.write_terminal(f"\nUploaded {report['files']} file(s) of {job.jobname} ({report['bytes']/1e6:.1f} MB in {report['seconds']:.1f} s, {report['MBps']:.1f} MB/s), {report['skipped']} already on the host\n")
+            for name, content in files:
+                if name == "msa_cache.tsv":
+                    self.report_msa_cache(job, content)
+
+            if not launch:
+                self.set_stage(job, "done", "Files created but not submitted")
+                notify("info", "Files created but not submeted since alignments and models are deactivated")
+                return True
+
+            self.set_stage(job, "submitted")
+            notify("success", "job submitted")
+            if self.HOST.tracker is not None:
+                self.HOST.tracker.add(job, self.set_stage)
+            self.launch_job(job)
+            self.save_job(job)
+            return True
+        except Exception as e:
+            self.set_stage(job, "failed", str(e))
+            notify("error", f"Submission of {job.jobname} failed: {e}", 0)
+            return False
+
+    def submit_batch(self, manifest, chunks, launch):
+        """
+        Submit every chunk of a batch, one after the other. Returns the summary of the stages.
+        """
+        self.HOST.run_command(f"mkdir -p {manifest.workdir}")
+        for job, files in chunks:
+            self.submit_job(job, files, launch)
+        manifest.save(self.HOST.get_sftp())
+        summary = ", ".join(f"{n} {stage}" for stage, n in manifest.summary().items())
+        self.HOST.write_terminal(f"\nBatch {manifest.jobname}: {summary}\n")
+        return summary
+
+    def launch_job(self, job):
+        """
+        Launch the scripts of the job with the executor of the host.
+        With qsub each script depends on the previous one (-W depend=afterok) and the PBS ids are kept,
+        with bash the call returns at the end of the run.
+        On the local machine the job goes to the queue of the LocalExecutor.
+        """
+        if self.HOST.local:
+            self.set_stage(job, "queued", "Waiting for a free slot" + (" and GPU" if job.doModels else ""))
+            self.HOST.localExecutor.submit(job, self.local_job_done, self.local_job_started)
+        elif self.HOST.executor == "bash":
+            gpu = f"ALPHASUB_GPU={job.placement[1]} " if job.placement is not None else ""
+            outcode = self.HOST.run_command(" && ".join(f"{gpu}bash {script}" for script in job.scripts), cd=job.workdir)
+            if outcode != 0:
+                self.set_stage(job, "failed", f"Scripts exited with code {outcode}")
+            elif not job.finished:
+                self.set_stage(job, "done")
+        else:
+            depend = ""
+            for script in job.scripts:
+                placement = ""
+                if job.placement is not None and script == "run_pred.sh":
+                    #Command line options override the #PBS lines of the script
+                    node, gpu = job.placement
+                    mem = job.resources["mem"] if job.resources is not None else None
+                    placement = f"-l {self.HOST.pbs_select(node, mem=mem)} -v ALPHASUB_GPU={gpu} "
+                out = self.HOST.query(f"cd {job.workdir}; {self.HOST.executor} {depend}{placement}{script}")
+                self.HOST.write_terminal(out)
+                pbsId = out.strip()
+                if pbsId == "":
+                    self.set_stage(job, "failed", f"No job id returned for {script}")
+                    return
+                job.pbsIds.append(pbsId)
+                depend = f"-W depend=afterok:{pbsId} "
+            self.set_stage(job, "submitted")
+
+    def local_job_started(self, job):
+        gpu = f"GPU {job.placement[1]}" if job.placement is not None else "no GPU"
+        self.set_stage(job, "submitted", f"Running on {gpu}")
+
+    def local_job_done(self, job, returncode):
+        if isinstance(returncode, str):
+            self.set_stage(job, "failed", returncode)
+        elif returncode != 0:
+            self.set_stage(job, "failed", f"Scripts exited with code {returncode} (see alphasub_local.log)")
+        elif not job.finished:
+            self.set_stage(job, "done")
+
+    def save_job(self, job):
+        """
+        Write alphasub_job.json in the workdir, read back by status.
+        """
+        content = json.dumps({"jobname": job.jobname,
+                              "server": job.server,
+                              "doModels": job.doModels,
+                              "scripts": job.scripts,
+                              "pbsIds": job.pbsIds,
+                              "resources": job.resources,
+                              "submitted": job.submitted.strftime("%Y-%m-%d %H:%M:%S"),
+                              }, indent=2)
+        self.HOST.get_sftp().putfo(BytesIO(content.encode()), f"{job.workdir}/alphasub_job.json")
+
+    def submit(self, spec, launch=True):
+        """
+        Validate, generate and submit a JobSpec (all its chunks in batch mode). Returns the JobStatus.
+        Raises ValueError when an input is invalid, nothing is uploaded then.
+        """
+        stats = self.validate(spec)
+        invalid = [entry for entry in stats if len(entry["errors"]) > 0]
+        if len(invalid) > 0:
+            raise ValueError(f"Invalid input {invalid[0]['name']}: " + "; ".join(invalid[0]["errors"]))
+        manifest, chunks = self.prepare(spec, stats)
+        if manifest is not None:
+            self.submit_batch(manifest, chunks, launch)
+        else:
+            self.submit_job(chunks[0][0], chunks[0][1], launch)
+        return [job for job, files in chunks]
+
+    def status(self, workdirs):
+        """
+        Current stage of jobs submitted earlier (by the GUI, the API or the command line), from their
+        alphasub_job.json, sentinel files and qstat: two commands whatever the number of jobs.
+        Batch workdirs are expanded into their chunks (batch_manifest.json).
+        """
+        quoted = " ".join(shlex.quote(workdir.rstrip("/")) for workdir in workdirs)
+        out = self.HOST.query(f"for d in {quoted}; do "
+                              f"if [ -f \"$d/batch_manifest.json\" ]; then printf 'B\\t%s\\t' \"$d\"; tr -d '\\n' < \"$d/batch_manifest.json\"; echo; "
+                              f"else printf 'J\\t%s\\t' \"$d\"; tr -d '\\n' < \"$d/alphasub_job.json\" 2>/dev/null; echo; fi; done")
+        jobs = []
+        server = self.HOST.parameters.get("serverName", "")
+        for line in out.splitlines():
+            fields = line.split("\t", 2)
+            if len(fields) != 3:
+                continue
+            kind, workdir, content = fields
+            try:
+                info = json.loads(content) if content.strip() != "" else None
+            except ValueError:
+                info = None
+            entries = [info] if kind == "J" else (info or {}).get("chunks", [])
+            for entry in entries:
+                if entry is None:
+                    job = JobStatus(os.path.basename(workdir), workdir, server)
+                    job.set_stage("pending", "No alphasub_job.json in the workdir")
+                else:
+                    job = JobStatus(entry.get("jobname", entry.get("name", os.path.basename(workdir))), entry.get("workdir", workdir), server,
+                                    doModels=entry.get("doModels", True))
+                    job.pbsIds = entry.get("pbsIds", [])
+                    job.set_stage(entry.get("stage", "submitted"), entry.get("message", ""))
+                jobs.append(job)
+        tracker = JobTracker(self.HOST)
+        tracker.jobs = {job.workdir.rstrip("/"): job for job in jobs if job.stage != "pending"}
+        tracker.poll()
+        return jobs
+
+    def convert_parameters(self, p):
+        """
+        Convert parameter for bash command line.
+        Example, bool True should be 1, bool False should be 0..
+        """
+
+        #Bool
+        if isinstance(p, bool):
+            conversion = {True:1,False:0}
+            return conversion[p]
+        if isinstance(p, list):
+            conversion = {"fread (3)":3,
+                          "mmap (2)":2}
+            return conversion[p]
+
+    def generate_script(self, spec, jobname=None, workdir=None, pbsLines=None, gpuIndex=None, stage="all"):
+        """
+        Generate run_pred.sh for a JobSpec. jobname, workdir, PBS lines and GPU index can be
+        overridden (batch mode). stage can be "all", "search" (alignment only) or "models".
+        The script is also returned.
+        """
+        jobname = spec.jobname if jobname is None else jobname
+        workdir = spec.workdir if workdir is None else workdir
+        pbsLines = self.HOST.PBSlines if pbsLines is None else pbsLines
+        gpuIndex = self.HOST.gpu if gpuIndex is None else gpuIndex
+        doAlignment = spec.doAlignment and stage != "models"
+        doModels = spec.doModels and stage != "search"
+        #The search job has its own CPUs, give them all to MMseqs2.
+        threadsOption = f"--threads {spec.searchNcpus} " if stage == "search" else ""
+        useMsaCache = spec.useMsaCache and doAlignment
+
+        if spec.useAmber == True:
+            if spec.useGpuAmber:
+                minimisationString = "--amber --use-gpu-relax"
+            else:
+                minimisationString = "--amber"
+        else:
+            minimisationString = ""
+
+        script = f"""#!/bin/bash
+{pbsLines}
+
+# 1. ===== PARAMETER SETINGS <- NEED TO BE MODIFY AT EVERYRUN ========
+FASTA_FILE="{jobname}".fasta #FASTA NAME
+
+FASTA_DIR="{workdir}" #DIRECTORY OF THE FASTA FILE
+
+#  Default Options. Change it if you want :-) 
+MODELTYPE="{spec.modelVersion}" #COULD BE AlphaFold2-multimer-v1, AlphaFold2-multimer-v2, AlphaFold2-ptm, auto
+MINIMISATION="{minimisationString}" # COMMENT To remove minimisation
+NMER={spec.nmer} #Number of MERS, 2 for DIMERS (symetrical), 3 for Trimers..... /!\ IT IS DIFFERENT FROM MULTIMERS WITH 2 SEQUENCES SEPARATED BY ':'
+NUMRECYCLE={spec.numRecycle} #Number of recycling of each model. should be 3 at minimum to improve a bit models.
+
+DBLOADMODE={spec.dbLoadMode} #3 = faster reading but do not take advantage of cached files. 2 is faster when the databse is already in the memory. auto = 2 if the database is in the page cache.
+WARMTHRESHOLD={self.warmThreshold} #% of the database in the page cache to use mmap (2) in auto mode
+USEENV={self.convert_parameters(spec.useEnv)} # 0 = do not use environmental database, 1=Use environmentale databse. 
+
+DOALIGNMENT={"true" if doAlignment else "false"} # Comment or set to false if you already have a folder called "msas" with an a3m MSA inside.
+DOMODELS={"true" if doModels else "false"} # Comment or set to false if you don't want to make the models (only generate MSAS)
+GPUINDEX=${{ALPHASUB_GPU:-{gpuIndex}}} #ALPHASUB_GPU is set by the alphasub GPU scheduler. For multiGPU nodes, select only the GPU 0. Change to your favourite GPU number!
+
+
+# 2. ===== other parameters, don't change if except if you know what you are doing :-) 
+MSA_DIR=${{FASTA_DIR}}/msas #FOLDER THAT WILL CONTAIN THE MSA
+PRED_DIR=${{FASTA_DIR}}/predictions #FOLDER THAT WILL CONTAIN PREDICTIONS
+PARAMS_DIR={self.HOST.paramsFolder}
+DATABASES={self.HOST.databaseFolder}
+IMAGESINGULARITY={self.HOST.singularityImage} #LOCATION OF THE SINGULARITY IMAGE
+USEMSACACHE={"true" if useMsaCache else "false"} # Re-use MSAs already computed for the same sequence and search parameters
+MSACACHE={self.HOST.msaCacheDir} #LOCATION OF THE MSA CACHE
+MSACACHESIZE={int(self.HOST.msaCacheSize*1024*1024)} #SIZE LIMIT OF THE MSA CACHE IN KB
+
+# 3. ==== Creation of the output dir in the $FASTA_DIR
+mkdir -p ${{FASTA_DIR}} &> /dev/null
+mkdir -p ${{MSA_DIR}} &> /dev/null
+mkdir -p ${{PRED_DIR}} &> /dev/null
+
+# 4. ==== PREPARATION OF THE SINGULARITY COMMAND
+#     Note :  -B are mounting point to link folder on the host machine to the singularity container.
+SINGULARITYCOMAND="singularity exec \
+ -B ${{DATABASES}}:/alpha/database\
+ -B ${{FASTA_DIR}}:/inout/fasta\
+ -B ${{PARAMS_DIR}}:/opt/cache\
+ -B ${{MSA_DIR}}:/inout/msas -B ${{PRED_DIR}}:/inout/predictions --nv ${{IMAGESINGULARITY}}"
+
+cd $FASTA_DIR
+
+# ==== COMPRESSED TRANSFER: inputs were uploaded as one archive, kept so that resubmitting the same
+# inputs skips its upload. Only unpacked when it is newer than the last unpacking (not by the next stages).
+if [ -f inputs.tar.gz ] && [ inputs.tar.gz -nt inputs.tar.gz.unpacked ]; then
+    tar -xzf inputs.tar.gz && touch inputs.tar.gz.unpacked
+fi
+
+# 5. ==== MSA CACHE LOOKUP: queries already in the cache are put aside, only the others are searched.
+if [ "$USEMSACACHE" == true ] && [ "$DOALIGNMENT" == true ] && [ -f msa_cache.tsv ]; then
+    mkdir -p ${{MSACACHE}} msas_cache_hits
+    HITS=0
+    MISSES=0
+    > msa_cache_search.fasta
+    while IFS=$'\t' read -r key name seq; do
+        if [ -f "${{MSACACHE}}/$key.a3m" ]; then
+            ln -f "${{MSACACHE}}/$key.a3m" "msas_cache_hits/$name.a3m" 2>/dev/null || cp "${{MSACACHE}}/$key.a3m" "msas_cache_hits/$name.a3m"
+            touch "${{MSACACHE}}/$key.a3m" # Most recently used
+            HITS=$((HITS+1))
+        else
+            printf ">%s\n%s\n" "$name" "$seq" >> msa_cache_search.fasta
+            MISSES=$((MISSES+1))
+        fi
+    done < msa_cache.tsv
+    echo "MSA cache: $HITS hit(s), $MISSES miss(es)"
+    FASTA_FILE=msa_cache_search.fasta
+    if [ $MISSES -eq 0 ]; then
+        DOALIGNMENT=false
+        touch searchingSequencesDone # Every MSA came from the cache: the search is done (followed by JobTracker)
+    fi
+fi
+
+if [ "$DOALIGNMENT" == true ] && [ "$DBLOADMODE" == auto ]; then
+    DBRESIDENT=`{database_resident_command(" ".join("${DATABASES}/"+pattern for pattern in spec.database_patterns()))}`
+    if [ "${{DBRESIDENT:-0}}" -ge $WARMTHRESHOLD ]; then
+        DBLOADMODE=2
+    else
+        DBLOADMODE=3
+    fi
+    echo "Database resident in memory: ${{DBRESIDENT:-unknown}}% -> --db-load-mode $DBLOADMODE"
+fi
+
+if [ "$DOALIGNMENT" == true ]; then
+    echo "-- Doing alignment with MMSEQS --"
+    touch searchingSequences
+    $SINGULARITYCOMAND\\
+    colabfold_search -s {spec.sensitivity} \\
+    --db1 {spec.db1} \\
+    --db3 colabfold_envdb_202108_db \\
+    --use-env ${{USEENV}} \\
+    --use-templates {self.convert_parameters(spec.useTemplate)} \\
+    --filter {self.convert_parameters(spec.filter)} \
+    --expand-eval {spec.expandEval} \\
+    --align-eval {spec.alignEval} \\
+    --diff {self.convert_parameters(spec.diff)} \\
+    --qsc {spec.qsc} \\
+    --max-accept {spec.maxAccept} \\
+    --db-load-mode ${{DBLOADMODE}} {threadsOption}\\
+    /inout/fasta/${{FASTA_FILE}} /alpha/database/ /inout/msas > outalign.txt 2>&1
+
+    rm searchingSequences
+    touch searchingSequencesDone
+
+    echo "Renaming A3M files"
+    python3 ${{FASTA_DIR}}/{A3M_HELPER_NAME} rename msas
+fi
+
+# MSA CACHE UPDATE: new MSAs are stored, hits are put back, then least recently used MSAs are removed.
+if [ -d msas_cache_hits ]; then
+    while IFS=$'\t' read -r key name seq; do
+        if [ ! -f "${{MSACACHE}}/$key.a3m" ] && [ -f "msas/$name.a3m" ]; then
+            cp "msas/$name.a3m" "${{MSACACHE}}/$key.a3m"
+        fi
+    done < msa_cache.tsv
+    mv msas_cache_hits/*.a3m msas/ 2>/dev/null
+    rmdir msas_cache_hits
+    CACHETOTAL=`du -sk ${{MSACACHE}} | cut -f1`
+    for old in `ls -tr ${{MSACACHE}}/*.a3m`; do
+        if [ $CACHETOTAL -le $MSACACHESIZE ]; then
+            break
+        fi
+        oldsize=`du -k $old | cut -f1`
+        rm -f $old
+        CACHETOTAL=$((CACHETOTAL-oldsize))
+    done
+fi
+
+#Replace the models to have NMERS (per default : 1)
+python3 ${{FASTA_DIR}}/{A3M_HELPER_NAME} nmer msas $NMER
+
+
+if [ "$DOMODELS" == true ]; then
+  echo "-- Doing models --"
+  touch makingModels
+  CUDA_VISIBLE_DEVICES=$GPUINDEX $SINGULARITYCOMAND colabfold_batch --model-type ${{MODELTYPE}} $MINIMISATION --num-recycle $NUMRECYCLE /inout/msas /inout/predictions
+  rm makingModels
+  touch makingModelsDone
+  
+  cd predictions
+  NSEQS=`ls -l *.a3m | wc -l` 
+  #put each models into a subdirectory if there are several models made.
+  if [ $NSEQS -gt 1 ]; then
+    for file in `ls *.a3m`; do
+      seq=`basename -s .a3m $file`
+      mkdir $seq >/dev/null 2>&1
+      mv $seq* $seq >/dev/null 2>&1
+    done
+  fi
+  cd ..
+fi
+"""
+        return script
+
+
+class Alphafold():
+    """
+    Class for all parameters for alphafold.
+    Underlines respects the PARAM methodology to instance parameters.
+    """
+
+
+
+    def __init__(self, sshInstance):
 
-    def __init__(self, sshInstance):
-
 
         #Parameters
         self.HOST = sshInstance
         self.mode = "query" # Could be query, fasta, a3m
+        self.inputStats = [] # Stats of the inputs (see alphasub_a3m.validate), set by run_alphafold
+        #Script generation and submission, shared with the command line
+        self.submitter = Submitter(sshInstance)
+        self.submitter.listeners.append(lambda job: run_in_ui(self.HOST.doc, self.update_jobs_table))
 
         # MMSEQ
         # Positional arguments
@@ -486,6 +2675,8 @@ class Alphafold():
         
         # Uploading
         self.fastaFile = pn.widgets.FileInput(accept='.fasta', multiple=False)
+        self.batchMode = pn.widgets.Checkbox(name="Batch mode (one PBS job per chunk of sequences)", value=False)
+        self.chunkSize = pn.widgets.IntInput(name="Sequences per job", value=10, start=1)
         self.msasFile = pn.widgets.FileInput(accept='.a3m', multiple=True)
 
         self.dbbase = pn.widgets.TextInput(name = "database location", placeholder="Please write VALID path do database folder", value="/data/work/I2BC/pa.charbit/colabfold/database")
@@ -513,7 +2704,19 @@ class Alphafold():
         self.diff = pn.widgets.Checkbox(name="DIFF: Keep only most diverse", value=False)
         self.qsc = pn.widgets.FloatInput(name="threshold for the DIFF filterting", value=-20,)
         self.max_accept = pn.widgets.IntInput(name="max-accept (Maximum number of alignment results per query sequence)", value=10)
-        self.db_load_mode = pn.widgets.Select(name ="db_load_mode", options={"fread (3)":3,"mmap (2)":2}, value=3)
+        self.db_load_mode = pn.widgets.Select(name ="db_load_mode", options={"auto (2 if the database is in memory)":"auto", "fread (3)":3,"mmap (2)":2}, value="auto")
+        self.checkDatabaseCache = pn.widgets.Button(name="Check database cache", button_type='light')
+        self.checkDatabaseCache.on_click(self.check_database_cache)
+        self.preloadDatabase = pn.widgets.Button(name="Preload database", button_type='light')
+        self.preloadDatabase.on_click(self.preload_database)
+
+        # Search and models in 2 PBS jobs: CPU only for the search, GPU for the models (after the search).
+        self.splitStages = pn.widgets.Checkbox(name="Run the search in a separate CPU job", value=False)
+        self.searchNcpus = pn.widgets.IntInput(name="CPUs for the search job", value=16, start=1)
+        self.searchMem = pn.widgets.IntInput(name="Memory for the search job (GB)", value=64, start=1)
+
+        # Re-use MSAs already computed on the host for the same sequence and search parameters.
+        self.useMsaCache = pn.widgets.Checkbox(name="Use the MSA cache of the host", value=True)
 
         self.useOwnAlignment = pn.widgets.CheckButtonGroup(name="Use our own alignment", options=["Use my own alignment"], button_type='success')
         self.chooseAlignmentFile = pn.widgets.Button(name="Select alignment", button_type = 'light', height=25)
@@ -533,6 +2736,7 @@ class Alphafold():
         self.DOMODELS = pn.widgets.Checkbox(name="Produce models", value=True)
         self.use_gpu_amber = pn.widgets.Checkbox(name="Use GPU for minimisation", value=True, disabled=True)
         self.nmer = pn.widgets.IntInput(name="Number of oligomer", value=1, start=1, end=6)
+        self.autoPlace = pn.widgets.Checkbox(name="Place the job on the best free GPU of all nodes", value=False)
         
 
 
@@ -546,6 +2750,13 @@ class Alphafold():
         #Control widgets
         self.GOGOGO = pn.widgets.Button(name="GOGOGO", button_type='danger')
 
+        #Submitted jobs (key: host workdir), updated by the submission threads.
+        self.jobs = {}
+        self.pollInterval = 30 #seconds between two checks of the sentinel files
+        self.jobsTable = pn.widgets.Tabulator(pd.DataFrame(columns=list(JobStatus("", "", "").as_dict().keys())),
+                                              name="jobsTable", disabled=True, show_index=False)
+        self.tableCallback = None # Refresh of the elapsed time and queue position of the jobs
+
         #DEBUG
         self.editor = pn.widgets.Ace(value="", sizing_mode='stretch_both', language='sh', height=800, visible=False)
 
@@ -562,7 +2773,8 @@ class Alphafold():
                                         MQSLKDNHGFVY
                                         ```
                                         """),
-                                        self.fastaFile
+                                        self.fastaFile,
+                                        pn.Row(self.batchMode, self.chunkSize),
                                         )
         ))
         self.querybox.append(("Multiple Sequence Alignment",pn.Column(
@@ -598,6 +2810,10 @@ class Alphafold():
                                          self.qsc,
                                          self.max_accept,
                                          self.db_load_mode,
+                                         pn.Row(self.checkDatabaseCache, self.preloadDatabase),
+                                         self.splitStages,
+                                         pn.Row(self.searchNcpus, self.searchMem),
+                                         self.useMsaCache,
                                          title="Advanced parameters",
                                          collapsed =True,
                                          )
@@ -610,6 +2826,7 @@ class Alphafold():
             pn.Row(self.use_amber, self.use_gpu_amber),
             self.NumRecycle,
             self.nmer,
+            self.autoPlace,
         )
         self.modelAdvanced = pn.Card(title="Advanced parameters", collapsed =True)
         self.modelTab = pn.Column(self.modelBasics, self.modelAdvanced)
@@ -622,6 +2839,7 @@ class Alphafold():
 
     
     def select_files(self, *b):
+        from tkinter import Tk, filedialog
         root = Tk()
         root.withdraw()                                        
         root.call('wm', 'attributes', '.', '-topmost', True)   
@@ -682,19 +2900,57 @@ class Alphafold():
             self.alignmentFileRow.visible=True
             
     def run_command(self, cmd, cd=None):
-        if cd != None:
-            cmd = f"cd {cd}; {cmd}"
-
+        return self.HOST.run_command(cmd, cd=cd)
 
-        stdin, stdout, stderr = self.HOST.ssh.exec_command(cmd)
 
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        self.HOST.terminal.write(out+"\n"+err)
-        return stdout.channel.recv_exit_status()
+    def job_spec(self):
+        """
+        JobSpec of the current values of the widgets.
+        """
+        spec = JobSpec(self.jobname.value, self.HOST.hostWorkdir,
+                       doAlignment=self.DOALIGNMENT.value,
+                       doModels=self.DOMODELS.value,
+                       modelVersion=self.modelVersion.value,
+                       nmodels=self.Nmodels.value,
+                       numRecycle=self.NumRecycle.value,
+                       useAmber=self.use_amber.value,
+                       useGpuAmber=self.use_gpu_amber.value,
+                       nmer=self.nmer.value,
+                       sensitivity=self.sensitivity.value,
+                       db1=self.db1.value,
+                       useEnv=self.use_env.value,
+                       useTemplate=self.use_template.value,
+                       filter=self.filter.value,
+                       expandEval=self.expand_eval.value,
+                       alignEval=self.align_eval.value,
+                       diff=self.diff.value,
+                       qsc=self.qsc.value,
+                       maxAccept=self.max_accept.value,
+                       dbLoadMode=self.db_load_mode.value,
+                       splitStages=self.splitStages.value,
+                       searchNcpus=self.searchNcpus.value,
+                       searchMem=self.searchMem.value,
+                       useMsaCache=self.useMsaCache.value,
+                       autoPlace=self.autoPlace.value,
+                       batch=self.batchMode.value,
+                       chunkSize=self.chunkSize.value,
+                       )
+        if self.mode == "query":
+            spec.query = self.query.value
+        elif self.mode == "fasta":
+            spec.fasta = self.fastaFile.value.decode("utf-8")
+        else:
+            spec.msas = list(zip(self.msasFile.filename, self.msasFile.value))
+        return spec
 
 
     def run_alphafold(self, *b):
+        """
+        Callback of the GOGOGO button.
+        Everything that needs the widgets is read here (see job_spec), then the validation, the script
+        generation, the upload and the launch are done in a worker thread (see submit_spec) so the
+        button returns straight away.
+        """
 
         # Clear notifications.
         pn.state.notifications.clear()
@@ -705,208 +2961,487 @@ class Alphafold():
             pn.state.notifications.error("No connexion to host", duration=0)
             return 0
 
-        #Generate the script to be coppy into the host
-        self.generate_script()
-
-
-        self.editor.visible=True #This is for debuging
-
         # Check Connexion
-        workdir = self.HOST.hostWorkdir.value
+        workdir = self.HOST.hostWorkdir
         if workdir == "":
             pn.state.notifications.error("Host ouput dir is empty. Please check again", duration=0)
             return 0
 
-        #Check Connectivity: 
-        outcode = self.run_command(f'mkdir -p {workdir}; cd {workdir}')
-        print(workdir)
-        if outcode != 0:
-            pn.state.notifications.error("Cannot create output directory. Please check terminal output", duration=0)
-            return 0
+        spec = self.job_spec()
+        self.start_table_refresh()
+        notifications = pn.state.notifications
+        worker = threading.Thread(target=self.submit_spec, args=(spec, notifications), daemon=True)
+        worker.start()
+        notifications.info(f"Checking the inputs of {spec.jobname}...", duration=2000)
+        return 1
 
-        #Create the script
-        ftp = self.HOST.ssh.open_sftp()
-        ftp.chdir(workdir)
-        #Write script
-        ftp.putfo(BytesIO(self.script.encode()), "run_pred.sh")
-        
 
-        #self.run_command(f'echo "{self.script}" > run_pred.sh')
+    def submit_spec(self, spec, notifications=None):
+        """
+        Check the inputs, generate the scripts and submit the job(s) of spec. Runs in a worker thread,
+        the outcome is reported through notifications.
+        """
+        notify = self.notifier(notifications)
+        try:
+            if spec.mode == "fasta" and spec.batch and len(parse_fasta(spec.fasta)) == 0:
+                notify("error", "No sequence found in the fasta file", duration=0)
+                return False
+
+            #Check the inputs before anything is uploaded
+            self.inputStats = self.submitter.validate(spec)
+            invalid = [stats for stats in self.inputStats if len(stats["errors"]) > 0]
+            if len(invalid) > 0:
+                for stats in invalid:
+                    self.HOST.write_terminal(f"\nInvalid input {stats['name']}:\n" + "".join(f"    {error}\n" for error in stats["errors"]))
+                notify("error", f"Invalid input {invalid[0]['name']}: {invalid[0]['errors'][0]} (see terminal)", duration=0)
+                return False
+
+            #Generate the script(s) to be coppy into the host
+            manifest, chunks = self.submitter.prepare(spec, self.inputStats)
+        except Exception as e:
+            self.HOST.write_terminal(f"\nCannot prepare {spec.jobname}: {e}\n")
+            notify("error", f"Cannot prepare {spec.jobname}: {e}", duration=0)
+            return False
+
+        job, files = chunks[0]
+        run_in_ui(self.HOST.doc, self.show_prepared, dict(files)[job.scripts[-1]].decode(), chunks)
+        if manifest is None:
+            resources = job.resources
+            self.HOST.write_terminal(f"\nEstimated resources of {job.jobname}: {resources['residues']} residues, "
+                                     f"{resources['gpuMemory']} MiB GPU, {resources['mem']} GB RAM, walltime {resources['walltime']}\n")
+
+        launch = spec.doAlignment or spec.doModels
+        if manifest is not None:
+            notify("info", f"Submitting {sum(len(names) for names in manifest.sequences.values())} sequences in {len(chunks)} jobs...", duration=2000)
+            self.submit_batch(manifest, chunks, launch, notifications)
+            return True
+
+        if not spec.autoPlace and spec.doModels and not self.HOST.local:
+            self.check_node_memory(job.resources, notify)
+
+        if spec.autoPlace and spec.doModels and self.HOST.scheduler is not None and not self.HOST.local:
+            self.submitter.set_stage(job, "queued", f"Waiting for a GPU with {job.requiredMemory} MiB")
+            try:
+                placed = self.HOST.scheduler.request(job, lambda job: self.submitter.submit_job(job, files, launch, notify))
+            except Exception as e:
+                self.submitter.set_stage(job, "failed", f"Could not place the job: {e}")
+                notify("error", f"Could not place {job.jobname}: {e}", duration=0)
+                return False
+            if not placed:
+                notify("info", f"No free GPU for {job.jobname}, the job is queued", duration=3000)
+            return True
 
-        #Create the fasta file
-        if self.mode == "query":
-            if not self.query.value.startswith(">"):
-                content = f">{self.jobname.value}\n{self.query.value}"
-            else:
-                content = f"{self.query.value}"
-            ftp.putfo(BytesIO(content.encode()), f"{self.jobname.value}.fasta")
+        notify("info", f"Submitting {job.jobname}...", duration=2000)
+        return self.submitter.submit_job(job, files, launch, notify)
 
-        elif self.mode == "fasta":
-            content = self.fastaFile.value.decode("utf-8")
-            ftp.putfo(BytesIO(content.encode()), self.jobname.value+".fasta")
-
-        elif self.mode == "a3m":
-            self.run_command(f'pwd; mkdir {workdir}/msas')
-            for i in range(len(self.msasFile.value)):
-                content = self.msasFile.value[i]
-                name = self.msasFile.filename[i]
-                name = name.replace(" ","_").replace("'","")
-                ftp.putfo(BytesIO(content), f"msas/{name}")
 
-        
-        
-        if self.DOALIGNMENT.value == True or self.DOMODELS.value == True:
-            self.run_command(f"{self.HOST.executor} run_pred.sh", cd=workdir)
-            pn.state.notifications.success("job submitted")
-        else:
-            pn.state.notifications.info("Files created but not submeted since alignments and models are deactivated")
+    def show_prepared(self, script, chunks):
+        """
+        Show the generated script and add the prepared jobs to the jobs table.
+        """
+        self.script = script
+        self.editor.value = script
+        self.editor.width = 800
+        self.editor.visible=True #This is for debuging
+        for job, files in chunks:
+            self.jobs[job.workdir] = job
+        self.update_jobs_table()
 
-        
 
-    def convert_parameters(self, p):
+    def notifier(self, notifications):
         """
-        Convert parameter for bash command line.
-        Example, bool True should be 1, bool False should be 0..
+        notify(kind, message, duration) for the submission threads: shows a notification in the session.
         """
+        doc = self.HOST.doc
+        def notify(kind, message, duration=3000):
+            if notifications is not None:
+                run_in_ui(doc, getattr(notifications, kind), message, duration=duration)
+        return notify
 
-        #Bool
-        if isinstance(p, bool):
-            conversion = {True:1,False:0}
-            return conversion[p]
-        if isinstance(p, list):
-            conversion = {"fread (3)":3,
-                          "mmap (2)":2}
-            return conversion[p]
 
-    def generate_script(self):
+    def submit_batch(self, manifest, chunks, launch, notifications=None):
+        """
+        Submit every chunk of a batch, one after the other. Runs in a worker thread.
+        """
+        summary = self.submitter.submit_batch(manifest, chunks, launch)
+        if notifications is not None:
+            run_in_ui(self.HOST.doc, notifications.success, f"Batch {manifest.jobname} submitted ({summary})", duration=3000)
+
 
-        if self.use_amber.value == True:
-            if self.use_gpu_amber.value:
-                minimisationString = "--amber --use-gpu-relax"
+    def check_node_memory(self, resources, notify):
+        """
+        Warn when the selected GPU has less memory than the estimation.
+        """
+        if self.HOST.gpudf is None or self.HOST.selectedgpu not in self.HOST.gpudf.index:
+            return
+        total = self.HOST.gpudf.loc[self.HOST.selectedgpu, "total memory (MiB)"]
+        if not pd.isna(total) and total < resources["gpuMemory"]:
+            message = f"The job needs about {resources['gpuMemory']} MiB of GPU memory, the selected GPU has {int(total)} MiB"
+            self.HOST.write_terminal(f"\n{message}\n")
+            notify("warning", message, duration=5000)
+
+
+    def check_database_cache(self, *b):
+        patterns = self.job_spec().database_patterns()
+        def check(notifications):
+            try:
+                fraction = self.HOST.check_database_cache(patterns)
+            except Exception as e:
+                fraction = None
+                self.HOST.write_terminal(f"\nCannot check the database cache: {e}\n")
+            if fraction is None:
+                message = "Cannot measure the database cache (vmtouch or fincore needed on the node)"
             else:
-                minimisationString = "--amber"
-        else:
-            minimisationString = ""
+                mode = 2 if fraction*100 >= self.submitter.warmThreshold else 3
+                message = f"Database resident in memory: {fraction:.0%} (auto mode uses --db-load-mode {mode})"
+            self.HOST.write_terminal(f"\n{message}\n")
+            if notifications is not None:
+                run_in_ui(self.HOST.doc, notifications.info, message, duration=4000)
+        threading.Thread(target=check, args=(pn.state.notifications,), daemon=True).start()
+
+
+    def preload_database(self, *b):
+        patterns = self.job_spec().database_patterns()
+        def preload(notifications):
+            outcode = self.HOST.preload_database(patterns)
+            if notifications is not None:
+                if outcode == 0:
+                    run_in_ui(self.HOST.doc, notifications.success, "Database preload launched", duration=3000)
+                else:
+                    run_in_ui(self.HOST.doc, notifications.error, "Database preload failed. Please check terminal output", duration=0)
+        threading.Thread(target=preload, args=(pn.state.notifications,), daemon=True).start()
 
-        script = f"""#!/bin/bash
-{self.HOST.PBSlines}
 
-# 1. ===== PARAMETER SETINGS <- NEED TO BE MODIFY AT EVERYRUN ========
-FASTA_FILE="{self.jobname.value}".fasta #FASTA NAME
+    def start_table_refresh(self):
+        if self.tableCallback is None:
+            self.tableCallback = pn.state.add_periodic_callback(self.update_jobs_table, period=self.pollInterval*1000)
 
-FASTA_DIR="{self.HOST.hostWorkdir.value}" #DIRECTORY OF THE FASTA FILE
 
-#  Default Options. Change it if you want :-) 
-MODELTYPE="{self.modelVersion.value}" #COULD BE AlphaFold2-multimer-v1, AlphaFold2-multimer-v2, AlphaFold2-ptm, auto
-MINIMISATION="{minimisationString}" # COMMENT To remove minimisation
-NMER={self.nmer} #Number of MERS, 2 for DIMERS (symetrical), 3 for Trimers..... /!\ IT IS DIFFERENT FROM MULTIMERS WITH 2 SEQUENCES SEPARATED BY ':'
-NUMRECYCLE={self.NumRecycle.value} #Number of recycling of each model. should be 3 at minimum to improve a bit models.
+    def update_jobs_table(self):
+        """
+        Refresh the jobs table. When no job was added only the changed cells are sent.
+        """
+        table = pd.DataFrame([job.as_dict() for job in self.jobs.values()], columns=self.jobsTable.value.columns)
+        old = self.jobsTable.value
+        if len(old) == 0 or len(old) != len(table):
+            self.jobsTable.value = table
+            return
+        patch = {}
+        for column in table.columns:
+            changes = [(i, value) for i, (value, previous) in enumerate(zip(table[column], old[column])) if value != previous]
+            if len(changes) > 0:
+                patch[column] = changes
+        if len(patch) > 0:
+            self.jobsTable.patch(patch)
 
-DBLOADMODE={self.db_load_mode.value} #3 = faster reading but do not take advantage of cached files. 2 is faster when the databse is already in the memory.
-USEENV={self.convert_parameters(self.use_env.value)} # 0 = do not use environmental database, 1=Use environmentale databse. 
 
-DOALIGNMENT={"true" if self.DOALIGNMENT.value else "false"} # Comment or set to false if you already have a folder called "msas" with an a3m MSA inside.
-DOMODELS={"true" if self.DOMODELS.value else "false"} # Comment or set to false if you don't want to make the models (only generate MSAS)
-GPUINDEX={self.HOST.gpuPanel.value} #For multiGPU nodes, select only the GPU 0. Change to your favourite GPU number!
 
+FileEntry = namedtuple("FileEntry", ["name", "path", "isdir", "size", "mtime"])
 
-# 2. ===== other parameters, don't change if except if you know what you are doing :-) 
-MSA_DIR=${{FASTA_DIR}}/msas #FOLDER THAT WILL CONTAIN THE MSA
-PRED_DIR=${{FASTA_DIR}}/predictions #FOLDER THAT WILL CONTAIN PREDICTIONS
-PARAMS_DIR={self.HOST.paramsFolder.value}
-DATABASES={self.HOST.databaseFolder.value}
-IMAGESINGULARITY={self.HOST.singularityImage.value} #LOCATION OF THE SINGULARITY IMAGE
 
-# 3. ==== Creation of the output dir in the $FASTA_DIR
-mkdir -p ${{FASTA_DIR}} &> /dev/null
-mkdir -p ${{MSA_DIR}} &> /dev/null
-mkdir -p ${{PRED_DIR}} &> /dev/null
+class LocalFiles():
+    """
+    Access to a results folder on the machine running panel.
+    """
+    def scandir(self, folder):
+        return [FileEntry(e.name, e.path, e.is_dir(), e.stat().st_size, e.stat().st_mtime) for e in os.scandir(folder)]
 
-# 4. ==== PREPARATION OF THE SINGULARITY COMMAND
-#     Note :  -B are mounting point to link folder on the host machine to the singularity container.
-SINGULARITYCOMAND="singularity exec \
- -B ${{DATABASES}}:/alpha/database\
- -B ${{FASTA_DIR}}:/inout/fasta\
- -B ${{PARAMS_DIR}}:/opt/cache\
- -B ${{MSA_DIR}}:/inout/msas -B ${{PRED_DIR}}:/inout/predictions --nv ${{IMAGESINGULARITY}}"
+    def stat(self, path):
+        """(size, mtime) of path, None if it doesn't exist"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
 
-cd $FASTA_DIR
+    def isdir(self, path):
+        return os.path.isdir(path)
 
+    def local_path(self, path, size=None, mtime=None):
+        return path
 
+    def prefetch(self, paths):
+        pass
 
-if [ "$DOALIGNMENT" == true ]; then
-    echo "-- Doing alignment with MMSEQS --"
-    touch searchingSequences
-    $SINGULARITYCOMAND\\
-    colabfold_search -s {self.sensitivity.value} \\
-    --db1 {self.db1.value} \\
-    --db3 colabfold_envdb_202108_db \\
-    --use-env ${{USEENV}} \\
-    --use-templates {self.convert_parameters(self.use_template.value)} \\
-    --filter {self.convert_parameters(self.filter.value)} \
-    --expand-eval {self.expand_eval.value} \\
-    --align-eval {self.align_eval.value} \\
-    --diff {self.convert_parameters(self.diff.value)} \\
-    --qsc {self.qsc.value} \\
-    --max-accept {self.max_accept.value} \\
-    --db-load-mode ${{DBLOADMODE}} \\
-    /inout/fasta/${{FASTA_FILE}} /alpha/database/ /inout/msas > outalign.txt 2>&1
 
-    rm searchingSequences
-    touch searchingSequencesDone
+class RemoteFiles():
+    """
+    Access to a results folder on the host through the SFTP connexion of the pool.
+    Nothing is mirrored: files are downloaded when they are opened, into cacheDir/serverName/path.
+    A cached file is reused as long as the remote file has the same size and mtime
+    (the local copy gets the mtime of the remote file).
+    """
+    def __init__(self, host, cacheDir="~/.alphasub/results_cache"):
+        self.HOST = host
+        self.cacheDir = os.path.join(os.path.expanduser(cacheDir), host.parameters.get("serverName", "host"))
+        self.locks = {} # path -> lock, one download of a given file at a time
+        self.locksLock = threading.Lock()
+
+    def scandir(self, folder):
+        entries = self.HOST.get_sftp().listdir_attr(folder)
+        return [FileEntry(a.filename, f"{folder.rstrip('/')}/{a.filename}", stat.S_ISDIR(a.st_mode), a.st_size, a.st_mtime) for a in entries]
+
+    def stat(self, path):
+        try:
+            attr = self.HOST.get_sftp().stat(path)
+        except IOError:
+            return None
+        return attr.st_size, attr.st_mtime
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.HOST.get_sftp().stat(path).st_mode)
+        except IOError:
+            return False
+
+    def path_lock(self, path):
+        with self.locksLock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def local_path(self, path, size=None, mtime=None):
+        """
+        Path of the local copy of the remote file path, downloaded if missing or outdated.
+        size and mtime of the remote file save a stat when they are already known (see PredictionIndex).
+        """
+        local = self.cache_path(path)
+        remote = self.stat(path) if size is None or mtime is None else (size, mtime)
+        if remote is None:
+            return local if os.path.isfile(local) else path
+        size, mtime = remote
+        with self.path_lock(path):
+            if self.is_cached(path, size, mtime):
+                return local
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            self.HOST.get_sftp().get(path, local+".part")
+            os.utime(local+".part", (time.time(), mtime))
+            os.replace(local+".part", local)
+        return local
+
+    def cache_path(self, path):
+        return os.path.join(self.cacheDir, path.lstrip("/"))
+
+    def is_cached(self, path, size, mtime):
+        local = self.cache_path(path)
+        if not os.path.isfile(local):
+            return False
+        st = os.stat(local)
+        return st.st_size == size and int(st.st_mtime) == int(mtime)
+
+    def prefetch(self, paths):
+        """
+        Download the missing or outdated files of paths in one gzip compressed tar stream per folder
+        (compressed transfer mode). tar keeps the mtimes, so the cache sees them as up to date.
+        """
+        folders = {}
+        for path in paths:
+            folders.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+        for folder, names in folders.items():
+            remote = {entry.name: entry for entry in self.scandir(folder)}
+            names = [name for name in names if name in remote and not self.is_cached(f"{folder}/{name}", remote[name].size, remote[name].mtime)]
+            if len(names) == 0:
+                continue
+            localDir = self.cache_path(folder)
+            os.makedirs(localDir, exist_ok=True)
+            stdin, stdout, stderr = self.HOST.ssh.exec_command(f"tar -czf - -C {shlex.quote(folder)} {' '.join(shlex.quote(n) for n in names)}")
+            with tarfile.open(fileobj=stdout, mode="r|gz") as tar:
+                for member in tar:
+                    if member.isfile() and member.name in names:
+                        with self.path_lock(f"{folder}/{member.name}"):
+                            tar.extract(member, localDir)
+
+
+class PredictionIndex():
+    """
+    Index of a predictions/ folder: for every job its folder, models (rank, relaxed or not, PDB and
+    scores files), PNGs and A3M. refresh() lists the folder once and only rescans the job folders whose
+    mtime changed, so it can be called every few seconds to follow a running job.
+    The folder contains one sub-folder per job, or the files of a single job directly.
+    """
+    MODEL = re.compile(r"^(?P<job>.+?)_(?P<relax>relaxed|unrelaxed)_(?P<model>.+?)(?P<scores>_scores)?\.(pdb|json)$")
+    RANK = re.compile(r"rank_(\d+)")
 
-    cd msas
-    echo "Renaming A3M files"
-  for file in `ls *.a3m`; do
-  filename=`python3 <<EOF
-input = open("$file", 'r')
-while input:
-    line=input.readline()
-    if line.startswith('>'):
-        name=line.replace('>','').strip().split('\\t')[0]
-        print(name)
-        break
-EOF
-`
-  echo $filename
-    mv $file "${{filename}}.a3m"
-  done
-  cd ..
-fi
+    def __init__(self, folder, files=None):
+        self.folder = folder
+        self.files = LocalFiles() if files is None else files # LocalFiles or RemoteFiles
+        self.jobs = {} # job -> record, see scan_job
+        self.mtimes = {} # folder -> mtime at the last scan (listing signature for a single job folder)
+        self.lock = threading.Lock()
 
-#Replace the models to have NMERS (per default : 1)
-for file in `ls msas/*.a3m`;
-  do
-  echo $file
-  sed -i -E "s|(#[0-9]*\t)[0-9]+|\1$NMER|g" $file
-done
+    def scan_job(self, folder, entries=None):
+        """
+        Return (jobname, record) of the files of one folder, jobname is None if it has no job files.
+        entries is the listing of folder when it is already known.
+        """
+        record = {"dir": folder, "models": {}, "pngs": {}, "a3m": None}
+        jobname = None
+        for entry in self.files.scandir(folder) if entries is None else entries:
+            if entry.isdir:
+                continue
+            name = entry.name
+            if name.endswith(".a3m"):
+                record["a3m"] = entry.path
+                jobname = name[:-len(".a3m")]
+            elif name.endswith(".png"):
+                record["pngs"][name[:-len(".png")].split("_")[-1]] = entry.path
+            else:
+                match = self.MODEL.match(name)
+                if match is None:
+                    continue
+                jobname = jobname if jobname is not None else match.group("job")
+                model = record["models"].setdefault(match.group("model"), {"rank": None, "relaxed": None, "unrelaxed": None, "scores": None, "scoresSize": None, "scoresMtime": None})
+                rank = self.RANK.search(match.group("model"))
+                model["rank"] = int(rank.group(1)) if rank is not None else None
+                if match.group("scores"):
+                    model["scores"] = entry.path
+                    model["scoresSize"] = entry.size
+                    model["scoresMtime"] = entry.mtime
+                else:
+                    model[match.group("relax")] = entry.path
+        return jobname, record
 
+    def refresh(self):
+        """
+        Update the index and return the set of jobs that were added or changed.
+        The mtimes of the job folders come from the listing of the predictions folder: one round trip
+        to the host, plus one per changed job.
+        """
+        with self.lock:
+            changedJobs = set()
+            try:
+                entries = self.files.scandir(self.folder)
+            except (IOError, OSError):
+                entries = [] #Not created yet, or removed
+            subfolders = {entry.name: entry for entry in entries if entry.isdir}
+            if set(subfolders) != set(job for job, record in self.jobs.items() if record["dir"] != self.folder):
+                for job, record in list(self.jobs.items()):
+                    single = record["dir"] == self.folder
+                    if (single and len(subfolders) > 0) or (not single and job not in subfolders):
+                        del self.jobs[job] #Removed job (or single job moved into sub-folders)
+                        self.mtimes.pop(record["dir"], None)
+            if len(subfolders) == 0:
+                #Single job, the files are directly in the predictions folder.
+                #Its mtime doesn't change when a file is rewritten, compare the listing instead
+                signature = sorted((entry.name, entry.size, entry.mtime) for entry in entries)
+                if self.mtimes.get(self.folder) != signature:
+                    self.mtimes[self.folder] = signature
+                    jobname, record = self.scan_job(self.folder, entries)
+                    if jobname is not None:
+                        self.jobs = {jobname: record}
+                        changedJobs.add(jobname)
+            for job, entry in subfolders.items():
+                if self.mtimes.get(entry.path) != entry.mtime:
+                    self.mtimes[entry.path] = entry.mtime
+                    jobname, record = self.scan_job(entry.path)
+                    self.jobs[job] = record
+                    changedJobs.add(job)
+            return changedJobs
+
+    def job_names(self):
+        return sorted(self.jobs.keys())
+
+    def models(self, job):
+        """
+        Model names (PDB stems) of a job sorted by rank: relaxed models if there are any, unrelaxed otherwise.
+        """
+        models = sorted(self.jobs[job]["models"].values(), key=lambda m: (m["rank"] is None, m["rank"]))
+        relaxed = [m["relaxed"] for m in models if m["relaxed"] is not None]
+        pdbs = relaxed if len(relaxed) > 0 else [m["unrelaxed"] for m in models if m["unrelaxed"] is not None]
+        return [Path(pdb).stem for pdb in pdbs]
+
+
+class ScoresSummary():
+    """
+    One row per model of every job of a PredictionIndex: mean pLDDT, pTM, ipTM, rank and relaxed flag.
+    Scores files are parsed in a process pool (see alphasub_scores.py) and the table is cached in cacheDir (Parquet, or pickle
+    without pyarrow). A file is only parsed again when its mtime changed, so updating the summary of
+    a running campaign only costs the new models.
+    """
+    COLUMNS = ["Job", "Model", "Rank", "Relaxed", "Mean pLDDT", "pTM", "ipTM", "Max PAE", "Scores", "mtime"]
+
+    def __init__(self, index, cacheDir="~/.alphasub/summary_cache", poolThreshold=16):
+        self.index = index
+        source = f"{getattr(index.files, 'cacheDir', 'local')}:{index.folder}"
+        self.cacheBase = os.path.join(os.path.expanduser(cacheDir), hashlib.sha1(source.encode()).hexdigest())
+        self.poolThreshold = poolThreshold # Fewer files than this are parsed without process pool
+        self.table = pd.DataFrame(columns=self.COLUMNS)
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Table of the last update, from the cache file.
+        """
+        try:
+            if os.path.isfile(self.cacheBase+".parquet"):
+                return pd.read_parquet(self.cacheBase+".parquet")
+            if os.path.isfile(self.cacheBase+".pkl"):
+                return pd.read_pickle(self.cacheBase+".pkl")
+        except Exception:
+            pass #Unreadable cache, everything is parsed again
+        return pd.DataFrame(columns=self.COLUMNS)
+
+    def save(self, table):
+        os.makedirs(os.path.dirname(self.cacheBase), exist_ok=True)
+        try:
+            table.to_parquet(self.cacheBase+".parquet", index=False)
+        except ImportError:
+            table.to_pickle(self.cacheBase+".pkl")
+
+    def models(self):
+        """
+        (job, model, rank, relaxed, scores path, size, mtime) of every model with a scores file.
+        """
+        rows = []
+        for job, record in list(self.index.jobs.items()):
+            for name, model in record["models"].items():
+                if model["scores"] is not None:
+                    rows.append((job, name, model["rank"], model["relaxed"] is not None, model["scores"], model["scoresSize"], model["scoresMtime"]))
+        return rows
+
+    def local_path(self, path, size, mtime):
+        try:
+            return self.index.files.local_path(path, size, mtime)
+        except (IOError, OSError):
+            return path #Not downloaded: summarize gives a row of NaN
+
+    def update(self):
+        """
+        Parse the new and modified scores files, save and return the table.
+        """
+        with self.lock:
+            cached = self.load() if len(self.table) == 0 else self.table
+            known = {(path, mtime): row for path, mtime, row in zip(cached["Scores"], cached["mtime"], cached.to_dict("records"))}
+            rows = []
+            stale = []
+            for job, name, rank, relaxed, path, size, mtime in self.models():
+                row = known.get((path, mtime))
+                if row is None:
+                    row = {"Job": job, "Model": name, "Rank": rank, "Relaxed": relaxed, "Scores": path, "mtime": mtime}
+                    stale.append((row, size))
+                else:
+                    row = dict(row, Job=job, Model=name, Rank=rank, Relaxed=relaxed)
+                rows.append(row)
+
+            if len(stale) > 0:
+                files = self.index.files
+                files.prefetch([row["Scores"] for row, size in stale]) #One archive for all the files of the host
+                #Size and mtime of the index: no stat per file to check the local copies
+                paths = [self.local_path(row["Scores"], size, row["mtime"]) for row, size in stale]
+                if len(paths) < self.poolThreshold:
+                    scores = [alphasub_scores.summarize(path) for path in paths]
+                else:
+                    workers = os.cpu_count() or 1
+                    with process_pool(workers) as pool:
+                        scores = list(pool.map(alphasub_scores.summarize, paths, chunksize=max(1, len(paths) // (4*workers))))
+                for (row, size), values in zip(stale, scores):
+                    row.update(values)
+
+            table = pd.DataFrame(rows, columns=self.COLUMNS)
+            table = table.sort_values(["Job", "Rank"], na_position="last").reset_index(drop=True)
+            if len(stale) > 0 or len(table) != len(cached):
+                self.save(table)
+            self.table = table
+            return table
 
-if [ "$DOMODELS" == true ]; then
-  echo "-- Doing models --"
-  touch makingModels
-  CUDA_VISIBLE_DEVICES=$GPUINDEX $SINGULARITYCOMAND colabfold_batch --model-type ${{MODELTYPE}} $MINIMISATION --num-recycle $NUMRECYCLE /inout/msas /inout/predictions
-  rm makingModels
-  touch makingModelsDone
-  
-  cd predictions
-  NSEQS=`ls -l *.a3m | wc -l` 
-  #put each models into a subdirectory if there are several models made.
-  if [ $NSEQS -gt 1 ]; then
-    for file in `ls *.a3m`; do
-      seq=`basename -s .a3m $file`
-      mkdir $seq >/dev/null 2>&1
-      mv $seq* $seq >/dev/null 2>&1
-    done
-  fi
-  cd ..
-fi
-"""
-        self.script = script
-        self.editor.value=script
-        self.editor.width=800
-        
-        
 
 class Results():
     """Class that will contain all results widgets"""
@@ -917,15 +3452,49 @@ class Results():
         # self.workdir = "/mnt/c/Users/tubia/OneDrive/Work/Postdoc/CNRS2022/projects/HCV/alphafold/construct_NS5A_single/"
         # self.workdir = "/mnt/c/Users/tubia/OneDrive/Work/Postdoc/CNRS2022/projects/noro/NS4_dim"
         #self.workdir = "/Users/thibault/cnrs2022/projects/noro/NS4_dim"
-
-        self.mainLayout = pn.Column()
+        self.files = LocalFiles() # LocalFiles, or RemoteFiles to browse the host workdir without copying it
+        self.doc = None
+
+        self.source = pn.widgets.RadioButtonGroup(name="Source", options=["Local", "Host"], value="Local", width=150)
+        self.source.param.watch(self.change_source, "value")
+        self.workdirInput = pn.widgets.TextInput(name="Results workdir", value=self.workdir)
+        self.loadButton = pn.widgets.Button(name="Load results", button_type="primary", width=150)
+        self.loadButton.on_click(self.open_results)
+
+        # Scores of every model of every job, sortable and paginated (only the shown page is sent)
+        self.summary = None # ScoresSummary of the predictions folder
+        self.summaryTable = pn.widgets.Tabulator(pd.DataFrame(columns=ScoresSummary.COLUMNS), name="summaryTable",
+                                                 disabled=True, show_index=False, pagination="remote", page_size=25,
+                                                 hidden_columns=["Scores", "mtime"],
+                                                 formatters={"Mean pLDDT": {"type": "money", "precision": 1},
+                                                             "pTM": {"type": "money", "precision": 3},
+                                                             "ipTM": {"type": "money", "precision": 3},
+                                                             "Max PAE": {"type": "money", "precision": 2},
+                                                             "Relaxed": {"type": "tickCross"}})
+        self.summaryCard = pn.Card(self.summaryTable, title="Summary of all models", collapsible=True)
+        self.summarizing = False # The summary is being updated in a thread
+        self.summaryDirty = False # Jobs changed during the update, it has to run again
+        self.summaryLock = threading.Lock()
+
+        self.mainLayout = pn.Column(pn.Row(self.source, self.workdirInput, self.loadButton))
         self.jobs = []
         self.tabs_index = {}
         self.jobsTabs = None
-        self.modelsMenus = []
-        self.PAEGraphsList = [] 
-        self.molstar = None#PDBeMolStar(height=500, sizing_mode='stretch_width',)
-        self.molstarLayout = []
+        self.index = None # PredictionIndex of the predictions folder
+        self.refreshPeriod = 5000 # ms between two checks of the predictions folder
+        self.remoteRefreshPeriod = 30000 # ms, every check of the host folder costs a few SFTP round trips
+        self.refreshCallback = None
+        self.refreshing = False # A remote refresh is running in a thread
+
+        # Tabs are only filled the first time they are shown. Built tabs are kept in a LRU,
+        # the least recently shown ones go back to a placeholder above maxBuiltTabs.
+        self.maxBuiltTabs = 10
+        self.builtTabs = OrderedDict() # job -> widgets of the tab (see build_tab)
+        self.loadingTabs = set() # Jobs whose files are being downloaded (see fetch_tab)
+
+        # PAE heatmaps are block-averaged to about one cell per screen pixel of the figure (see pae_max_cells),
+        # full resolution is only sent when zooming.
+        self.paePixels = 400 # CSS pixels of the heatmap in the results tab
 
         
         
@@ -933,240 +3502,468 @@ class Results():
 
 
 
-    def load_results(self):
-        self.find_models()
+    def change_source(self, event):
+        if event.new == "Host":
+            self.workdirInput.value = self.HOST.hostWorkdir
+        else:
+            self.workdirInput.value = self.workdir
+
+
+    def open_results(self, event):
+        """
+        (Re)load the results of the workdir, from the local disk or from the host.
+        """
+        if self.source.value == "Host":
+            if not self.HOST.isconnected:
+                pn.state.notifications.error("Connect to a host first", 2000)
+                return
+            self.files = RemoteFiles(self.HOST)
+        else:
+            self.files = LocalFiles()
+            self.workdir = self.workdirInput.value
+        self.doc = pn.state.curdoc
+        if self.refreshCallback is not None:
+            self.refreshCallback.stop()
+            self.refreshCallback = None
+        while len(self.mainLayout) > 1:
+            self.mainLayout.pop(-1)
+        self.jobs = []
+        self.tabs_index = {}
+        self.load_results(self.workdirInput.value)
+
+
+    def load_results(self, workdir=None):
+        workdir = self.workdir if workdir is None else workdir
+        if self.find_models(workdir) == 0:
+            return
         self.create_tabs()
+        self.summary = ScoresSummary(self.index)
+        self.summaryTable.value = self.summary.load()
+        self.update_summary()
+        self.mainLayout.append(self.summaryCard)
         self.mainLayout.append(pn.WidgetBox(self.jobsTabs))
 
         #Add watcher to update tabs
         self.jobsTabs.param.watch(self.update_tabs, "active")
-        self.update_graph(None)
+        if len(self.jobs) > 0:
+            self.update_tabs(None)
+
+        #New jobs and models show up without reloading
+        if self.refreshCallback is None and self.index is not None:
+            period = self.refreshPeriod if isinstance(self.files, LocalFiles) else self.remoteRefreshPeriod
+            self.refreshCallback = pn.state.add_periodic_callback(self.refresh_results, period=period)
+
+
+    def refresh_results(self):
+        """
+        Check the predictions folder. Remote folders are checked in a thread so the SFTP
+        round trips don't block the session.
+        """
+        if isinstance(self.files, LocalFiles):
+            self.update_results(self.index.refresh())
+        elif not self.refreshing:
+            self.refreshing = True
+            threading.Thread(target=self.refresh_remote, args=(self.index,), daemon=True).start()
+
+
+    def refresh_remote(self, index):
+        try:
+            changedJobs = index.refresh()
+        except Exception as e:
+            self.HOST.write_terminal(f"\nCould not refresh {index.folder}: {e}\n")
+            return
+        finally:
+            self.refreshing = False
+        if index is self.index: #Not reloaded in the meantime
+            run_in_ui(self.doc, self.update_results, changedJobs)
+
+
+    def update_summary(self):
+        """
+        Update the summary table in a thread, the scores files can take a while to parse.
+        Called during an update, it runs again once the current one is done.
+        """
+        with self.summaryLock:
+            if self.summarizing:
+                self.summaryDirty = True
+                return
+            self.summarizing = True
+        def summarize(summary):
+            while True:
+                try:
+                    table = summary.update()
+                except Exception as e:
+                    table = None
+                    self.HOST.write_terminal(f"\nCould not summarize {summary.index.folder}: {e}\n")
+                if table is not None and summary is self.summary: #Not reloaded in the meantime
+                    run_in_ui(self.doc, self.show_summary, table)
+                with self.summaryLock:
+                    if not self.summaryDirty:
+                        self.summarizing = False
+                        return
+                    self.summaryDirty = False
+                    summary = self.summary #The folder may have been reloaded meanwhile
+        threading.Thread(target=summarize, args=(self.summary,), daemon=True).start()
+
+
+    def show_summary(self, table):
+        #Keep the sorting chosen in the browser
+        self.summaryTable.value = table
+
+
+    def update_results(self, changedJobs):
+        """
+        Add the tabs of new jobs, drop the tabs of deleted jobs and add the new models of already built tabs.
+        """
+        if len(changedJobs) > 0:
+            self.update_summary()
+        removed = [job for job in self.jobs if job not in self.index.jobs]
+        if len(removed) > 0:
+            indices = [self.jobs.index(job) for job in removed]
+            for job in removed:
+                self.jobs.remove(job)
+                self.builtTabs.pop(job, None)
+            self.tabs_index = {i: job for i, job in enumerate(self.jobs)}
+            for index in sorted(indices, reverse=True):
+                self.jobsTabs.pop(index)
+            if len(self.jobs) > 0 and self.jobsTabs.active >= len(self.jobs):
+                self.jobsTabs.active = len(self.jobs)-1
+        for job in self.index.job_names():
+            if job not in self.jobs:
+                self.jobs.append(job)
+                self.tabs_index[len(self.jobs)-1] = job
+                self.jobsTabs.append((job, self.placeholder(job)))
+        for job in changedJobs:
+            if job not in self.builtTabs or job not in self.index.jobs:
+                continue
+            if "menu" in self.builtTabs[job]:
+                menu = self.builtTabs[job]["menu"]
+                value = menu.value
+                menu.options = self.index.models(job)
+                if value in menu.options:
+                    menu.value = value
+            else:
+                #Built before its first model: build it again
+                del self.builtTabs[job]
+                index = self.jobs.index(job)
+                self.jobsTabs[index] = (job, self.placeholder(job))
+                if self.jobsTabs.active == index:
+                    self.update_tabs(None)
         
-        #self.load_graph(self.jobsTabs.active)
 
+    def in_background(self, work, show, *args):
+        """
+        Call work(*args) in a thread (downloads from the host, PAE parsing), then show(result) on the
+        next tick of the session, as refresh_remote does.
+        """
+        def run():
+            try:
+                result = work(*args)
+            except Exception as e:
+                self.HOST.write_terminal(f"\nCould not load the results: {e}\n")
+                return
+            run_in_ui(self.doc, show, result)
+        threading.Thread(target=run, daemon=True).start()
 
-    def update_tabs(self, even):
-        # self.clear_tab(self.jobsTabs.active)
-        #self.load_graph(self.jobsTabs.active)
-        #print("change")
-        1+1
 
-    def find_models(self):
+    def update_tabs(self, event):
+        """
+        Build the active tab if needed: its files are fetched in a thread, see show_built_tab.
+        """
+        activetab = self.jobsTabs.active
+        job = self.tabs_index.get(activetab)
+        if job is None:
+            return #Every job was deleted
+        if job in self.builtTabs:
+            self.builtTabs.move_to_end(job)
+            return
+        if job in self.loadingTabs:
+            return
+        self.loadingTabs.add(job)
+        self.in_background(self.fetch_tab, self.show_built_tab, job)
+
+
+    def show_built_tab(self, data):
+        """
+        Build the tab of a job from the files fetched by fetch_tab and keep the LRU of built tabs bounded.
+        """
+        job = data["job"]
+        self.loadingTabs.discard(job)
+        if "error" in data:
+            #Left as a placeholder, fetched again when the tab is shown again
+            self.HOST.write_terminal(f"\nCould not load {job}: {data['error']}\n")
+            return
+        if data["index"] is not self.index or job not in self.jobs or job in self.builtTabs:
+            return #Reloaded or deleted in the meantime
+        self.builtTabs[job] = self.build_tab(job, data)
+        self.jobsTabs[self.jobs.index(job)] = (job, self.builtTabs[job]["layout"])
+
+        while len(self.builtTabs) > self.maxBuiltTabs:
+            oldjob, widgets = self.builtTabs.popitem(last=False)
+            index = self.jobs.index(oldjob)
+            self.jobsTabs[index] = (oldjob, self.placeholder(oldjob))
+
+    def find_models(self, workdir):
         #Check if prediction dir exist
-        dirs = os.listdir(self.workdir)
-        if not "predictions" in dirs:
+        predictionFolder = workdir.rstrip("/")+"/predictions"
+        if not self.files.isdir(predictionFolder):
             pn.state.notifications.error("No 'predictions' folder in workdir", 2000)
             return 0
-        predictionFolder = self.workdir+"/predictions"
-        self.jobs = [name for name in os.listdir(predictionFolder) if os.path.isdir(os.path.join(predictionFolder, name))]
-        if len(self.jobs) == 0:
-            from glob import glob
-            a3mfile = glob(f"{predictionFolder}/*.a3m")[0]
-            jobname = Path(a3mfile).stem
-            self.jobs = [jobname]
-            self.tabs_index[0] = jobname
+        self.index = PredictionIndex(predictionFolder, self.files)
+        self.index.refresh()
+        self.jobs = self.index.job_names()
             
+
+    def job_dir(self, job):
+        return self.index.jobs[job]["dir"]
         
 
-    def graph_PAE_json(self,path):
+    def pae_max_cells(self):
+        """
+        Cells per side of the PAE heatmaps: the size of the figure in device pixels, so HiDPI screens
+        get more detail. Panel 0.13 does not report the browser (pn.state.browser_info comes with
+        later versions), then the figure size in CSS pixels is used.
+        """
+        info = getattr(pn.state, "browser_info", None)
+        ratio = getattr(info, "device_pixel_ratio", None) or 1
+        return int(self.paePixels * min(max(ratio, 1), 3))
+
 
-        #1. Get PAE matrix
-        f = open(path, "r")
-        import json
-        j = json.load(f)
-        mat = np.asarray(j["pae"], dtype=np.float32)
-        
-        #2. Prepare graph object with plotly
-        #2.a convert bwr color map from matplotlib. Function taken on internet, can't remember where..
-        def matplotlib_to_plotly(cmap, pl_entries):
-            h = 1.0/(pl_entries-1)
-            pl_colorscale = []
-            for k in range(pl_entries):
-                C = list(map(np.uint8, np.array(cmap(k*h)[:3])*255))
-                pl_colorscale.append([k*h, 'rgb'+str((C[0], C[1], C[2]))])
-
-            return pl_colorscale
-        
-        bwr = matplotlib_to_plotly(matplotlib.cm.get_cmap('bwr'), 255)
-        magma = matplotlib_to_plotly(matplotlib.cm.get_cmap('magma'), 255)
-
-        heatmap = go.Heatmap(z=mat, colorscale=magma)
-        fig = go.Figure(data=[heatmap])
-        # mat = np.abs(30-mat)
-        # fig = go.Figure(data = go.Surface(z=mat, 
-        #                             colorscale=magma, 
-        #                             )
-        #         )
-        # fig.update_layout(
-        #           #title="PAE", 
-        #           xaxis_title="Residue",
-        #           yaxis_title="Residue", 
-        #           legend_title="PAE",
-        #         #   width=500,
-        #         #   height=500,                  
-        #     )
+    def PAE_data(self, path, xRange=None, yRange=None):
+        """
+        PAE data of a scores file. Without range, the whole matrix downsampled to pae_max_cells,
+        with ranges (in residues) only this region, at full resolution if it is small enough.
+        Returns z, x, y and whether the region is zoomed.
+        """
+        mat = load_pae(self.files.local_path(path))
+        rows = cols = None
+        if xRange is not None and yRange is not None:
+            n = mat.shape[0]
+            cols = slice(max(0, int(np.floor(min(xRange)))-1), min(n, int(np.ceil(max(xRange)))))
+            rows = slice(max(0, int(np.floor(min(yRange)))-1), min(n, int(np.ceil(max(yRange)))))
+            if cols.stop <= cols.start or rows.stop <= rows.start:
+                rows = cols = None
+        z, x, y = downsample_matrix(mat, self.pae_max_cells(), rows, cols)
+        return z, x, y, rows is not None
+
+
+    def graph_PAE_json(self, path, xRange=None, yRange=None):
+        return self.PAE_figure(self.PAE_data(path, xRange, yRange), xRange, yRange)
+
+
+    def PAE_figure(self, data, xRange=None, yRange=None):
+        """
+        New PAE figure from PAE_data. Colorscale and layout are shared, see plotly_colorscale and pae_layout.
+        """
+        import plotly.graph_objects as go
+        z, x, y, zoomed = data
+        heatmap = go.Heatmap(z=z, x=x, y=y, colorscale=plotly_colorscale("magma"))
+        fig = go.Figure(data=[heatmap], layout=pae_layout())
+        if zoomed:
+            fig.update_xaxes(range=list(xRange))
+            fig.update_yaxes(range=list(yRange))
         return fig
 
 
+    def update_PAE(self, pane, data, xRange=None, yRange=None):
+        """
+        Update the figure of pane in place with PAE_data: only the heatmap data (and axis ranges) change,
+        so panel sends a data update instead of a whole new figure.
+        """
+        if pane.object is None or len(pane.object.data) == 0:
+            pane.object = self.PAE_figure(data, xRange, yRange)
+            return
+        z, x, y, zoomed = data
+        fig = pane.object
+        with fig.batch_update():
+            fig.data[0].update(z=z, x=x, y=y)
+            fig.update_xaxes(range=list(xRange) if zoomed else None, autorange=not zoomed)
+            fig.update_yaxes(range=list(yRange) if zoomed else None, autorange=not zoomed)
+        pane.param.trigger("object")
 
-    def add_graph(self, activetab):
-        #activetab = self.jobsTabs.active
-        selected_model = self.modelsMenus[activetab].value
-        print(selected_model)
-        jsonFile = selected_model.replace("_relaxed_","_unrelaxed_")+"_scores.json"
-        
 
-        job = self.tabs_index[activetab]
-        if len(self.jobs) > 1:
-            curdir = self.workdir+"/predictions/"+job
-        else:
-            curdir = self.workdir+"/predictions/"
 
-        jsonFile = curdir+"/"+jsonFile
-        fig = self.graph_PAE_json(jsonFile)
+    def scores_file(self, job, model):
+        key = PredictionIndex.MODEL.match(model+".pdb").group("model")
+        scores = self.index.jobs[job]["models"][key]["scores"]
+        if scores is None: #Not indexed yet
+            return self.job_dir(job)+"/"+model.replace("_relaxed_","_unrelaxed_")+"_scores.json"
+        return scores
+
+
+    def add_graph(self, job, selected_model):
+        fig = self.graph_PAE_json(self.scores_file(job, selected_model))
         return fig
-        # self.PAEGraphsList[activetab] = fig
 
-        
-    def update_graph(self, event):
-        activetab = self.jobsTabs.active
-        job = self.tabs_index[activetab]
-        if len(self.jobs) > 1:
-            curdir = self.workdir+"/predictions/"+job
+
+    def zoom_PAE(self, job, event):
+        """
+        Called when the PAE heatmap is zoomed or reset: send the zoomed region at the best resolution.
+        """
+        widgets = self.builtTabs.get(job)
+        relayout = event.new
+        if widgets is None or not relayout:
+            return
+        jsonFile = self.scores_file(job, widgets["menu"].value)
+        if "xaxis.range[0]" in relayout and "yaxis.range[0]" in relayout:
+            xRange = (relayout["xaxis.range[0]"], relayout["xaxis.range[1]"])
+            yRange = (relayout["yaxis.range[0]"], relayout["yaxis.range[1]"])
+        elif relayout.get("xaxis.autorange") or relayout.get("yaxis.autorange"):
+            xRange = yRange = None
         else:
-            curdir = self.workdir+"/predictions/"
+            return
+        self.in_background(self.PAE_data, lambda data: self.update_PAE(widgets["pae"], data, xRange, yRange),
+                           jsonFile, xRange, yRange)
 
-        # print(self.jobsTabs)
-        # Ok this is hard... Uncomment the print the hierarchy of the interface and find the ID of the element to change 
-        # We have to do like this because otherwise no trigger are record and no change are shown.
-        
-        self.jobsTabs[activetab][1][0][0,0][1] = pn.pane.Plotly(self.add_graph(activetab))
-        # print("---------")
-        # print(self.jobsTabs[activetab][1][0][0,3])
-        model_name = self.jobsTabs[activetab][1][0][0,0][0].value
-        # self.jobsTabs[activetab][1][0][0,3:10] = self.load_pdbe(model=model_name, workdir=curdir)
-        
-        molstar_object = self.molstarLayout[activetab][0]#list(self.jobsTabs[activetab][1][0][0,3:10].objects.values())[0]
         
-        self.test_update_molstar( 
-            molstar_object,
-            model = model_name,
-            workdir=curdir
-            )
+    def update_graph(self, job, event):
+        """
+        Called when another model is selected in the tab of job: the scores and PDB files are
+        fetched in a thread, then the figure and the viewer are updated.
+        """
+        widgets = self.builtTabs.get(job)
+        if widgets is None: #The tab was evicted in the meantime
+            return
+        model_name = widgets["menu"].value
+        fetch = lambda model: (model, self.PAE_data(self.scores_file(job, model)), self.pdb_url(job, model))
+        self.in_background(fetch, partial(self.show_model, widgets), model_name)
 
-        # self.PAEGraphsList[activatetab] = self.add_graph(activatetab)
 
-    def test_update_molstar(self, molstar, model, workdir):    
+    def show_model(self, widgets, fetched):
+        model, data, url = fetched
+        if widgets["menu"].value != model:
+            return #Another model was selected in the meantime
+        self.update_PAE(widgets["pae"], data)
+        self.test_update_molstar(widgets["molstar"], url)
+
+
+    def pdb_url(self, job, model):
+        """
+        URL of the PDB of a model, downloaded first when browsing the host.
+        """
+        return f'assets/{self.files.local_path(self.job_dir(job)+"/"+model+".pdb")}'
+
+
+    def test_update_molstar(self, molstar, url):    
         molstar.custom_data = {
-                                    'url': f'assets/{workdir}/{model}.pdb',
+                                    'url': url,
                                     'format': 'pdb'
                                 }
     
-    def load_pdbe(self, model, workdir):
+    def load_pdbe(self, url):
         local_pdbe = PDBeMolStar(
                                 name='Local File',
                                 sizing_mode='stretch_width',
                                 height=500,
                                 custom_data = {
-                                    'url': f'assets/{workdir}/{model}.pdb',
+                                    'url': url,
                                     'format': 'pdb'
                                 },
                                 # alphafold_view=True, 
                             )
-        self.molstarLayout.append(pn.Row(local_pdbe))
         return local_pdbe
-        # self.molstar.custom_data = {
-        #                             'url': f'assets/{workdir}/{model}.pdb',
-        #                             'format': 'pdb'
-        #                         }
 
 
 
-    def create_visualisation_tabs(self, tabIndex):
-
-        job = self.tabs_index[tabIndex]
-        if len(self.jobs) > 1:
-            curdir = self.workdir+"/predictions/"+job
-        else:
-            curdir = self.workdir+"/predictions"
-
-        from glob import glob
-        models = glob(f"{curdir}/*_relaxed_*.pdb")
+    def create_visualisation_tabs(self, job, widgets, data):
 
+        models = data["models"]
         if len(models) == 0:
-            models = glob(f"{curdir}/*_unrelaxed_*.pdb")
-            hasRelax = False
-        else:
-            hasRelax = True
+            return pn.pane.Markdown("*No model yet*")
         
-        #Just keep models name
-        models = [Path(x).stem for x in models]
-        
-        self.modelsMenus.append(pn.widgets.Select(name="Model", options=models))
-        self.modelsMenus[-1].param.watch(self.update_graph, "value")
+        widgets["menu"] = pn.widgets.Select(name="Model", options=models)
+        widgets["menu"].param.watch(partial(self.update_graph, job), "value")
 
-        self.PAEGraphsList.append(pn.pane.Plotly(self.add_graph(tabIndex)))
+        widgets["pae"] = pn.pane.Plotly(self.PAE_figure(data["pae"]))
+        widgets["pae"].param.watch(partial(self.zoom_PAE, job), "relayout_data")
 
         visuLayout = pn.GridSpec(sizing_mode='stretch_both', mode="override")
 
-        colSettings =  pn.Column(self.modelsMenus[-1], 
-                         self.PAEGraphsList[-1])
+        colSettings =  pn.Column(widgets["menu"], 
+                         widgets["pae"])
 
         visuLayout[:,0:3] = colSettings
 
 
         #Now the graph....
-        self.molstar = self.load_pdbe(model=self.modelsMenus[-1].value, workdir=curdir)
-        visuLayout[:,3:10] = self.molstarLayout[-1]
+        widgets["molstar"] = self.load_pdbe(data["url"])
+        visuLayout[:,3:10] = pn.Row(widgets["molstar"])
         return visuLayout
         
 
 
     def create_tabs(self):
-        self.jobsTabs = pn.Tabs(dynamic=False)
-
-        self.PNGS_layouts = [] #For now, all pngs will be loaded... Not optimal but I'm still wating an answer from https://discourse.holoviz.org/t/update-same-instance-of-widget-on-multiple-tabs/3699 
+        """
+        Only the job names are listed here, the content of a tab is built when it is first shown.
+        """
+        self.jobsTabs = pn.Tabs(dynamic=True)
+        self.builtTabs = OrderedDict()
+        self.loadingTabs = set()
         for i,job in enumerate(self.jobs):
             self.tabs_index[i] = job #Set the "jobname" (baseame for files) for every tabs.
-            self.PNGS_layouts.append(self.load_graph(i)) #Load graphcics
-            visuPane = self.create_visualisation_tabs(i)
-            self.jobsTabs.append((job, pn.Column(
-                                                  pn.Card(self.PNGS_layouts[i], title="Main graphics",background="white"), 
-                                                  pn.Card(visuPane, title="Visualisation", background="white"),
-                                                 )
-                                ))
+            self.jobsTabs.append((job, self.placeholder(job)))
+
+
+    def job_files(self, job):
+        """
+        Files shown in the tab of a job: PNGs, scores and PDB of the models of the menu.
+        """
+        record = self.index.jobs[job]
+        files = list(record["pngs"].values())
+        files += [model["scores"] for model in record["models"].values() if model["scores"] is not None]
+        files += [f"{self.job_dir(job)}/{model}.pdb" for model in self.index.models(job)]
+        return files
+
+
+    def placeholder(self, job):
+        return pn.Column(pn.pane.Markdown(f"*Loading {job}...*"), name=job)
+
+
+    def fetch_tab(self, job):
+        """
+        Download the files of the tab of job (run in a thread, see update_tabs) and parse the PAE of its first model.
+        """
+        data = {"job": job, "index": self.index}
+        try:
+            data["models"] = self.index.models(job)
+            if self.HOST.compressTransfer:
+                self.files.prefetch(self.job_files(job))
+            curdir = self.job_dir(job)
+            pngs = self.index.jobs[job]["pngs"]
+            data["pngs"] = {name: self.files.local_path(pngs.get(name, f"{curdir}/{job}_{name}.png")) for name in ("PAE", "coverage", "plddt")}
+            if len(data["models"]) > 0:
+                data["pae"] = self.PAE_data(self.scores_file(job, data["models"][0]))
+                data["url"] = self.pdb_url(job, data["models"][0])
+        except Exception as e:
+            data["error"] = e
+        return data
+
+
+    def build_tab(self, job, data):
+        """
+        Build graphics, PAE figure and 3D viewer of a job from the files fetched by fetch_tab.
+        """
+        widgets = {}
+        widgets["pngs"] = self.load_graph(job, data["pngs"])
+        visuPane = self.create_visualisation_tabs(job, widgets, data)
+        widgets["layout"] = pn.Column(
+                                      pn.Card(widgets["pngs"], title="Main graphics",background="white"), 
+                                      pn.Card(visuPane, title="Visualisation", background="white"),
+                                     )
+        return widgets
             
 
-    def load_graph(self, tabIndex):
-        job = self.tabs_index[tabIndex]
-        if len(self.jobs) > 1:
-            curdir = self.workdir+"/predictions/"+job
-        else:
-            curdir = self.workdir+"/predictions"
+    def load_graph(self, job, pngs):
         #For now it will first the graphs made by our beloved colabfold 
+        #pngs: local paths of the PAE, coverage and plddt PNGs (see fetch_tab)
 
-        # PNGS_layout = pn.Card(pn.pane.PNG(f"{curdir}/{job}_PAE.png",height=200,sizingmode="stretch_width"),
-        #                         pn.Row(
-        #                             pn.pane.PNG(f"{curdir}/{job}_coverage.png",sizingmode="stretch_width"),
-        #                             pn.pane.PNG(f"{curdir}/{job}_plddt.png",sizingmode="stretch_width"),
-        #                             ), width_policy="max",
-        #                         )
-        # allPAES = pn.pane.PNG(f"{curdir}/{job}_PAE.png")
-        # coverage = pn.pane.PNG(f"{curdir}/{job}_coverage.png",sizingmode="stretch_width")
-        # plddt = pn.pane.PNG(f"{curdir}/{job}_plddt.png",sizingmode="stretch_width")
-        # PNGS_layout = pn.GridSpec(sizing_mode='stretch_both', max_height=600)
-        
         PNGS_layout = pn.GridSpec(sizing_mode='stretch_both', max_height=600, mode="override")
-        PNGS_layout[0,:] = f"{curdir}/{job}_PAE.png"
-        PNGS_layout[1:3,:2] = f"{curdir}/{job}_coverage.png"
-        PNGS_layout[1:3,2:4] = f"{curdir}/{job}_plddt.png"
+        PNGS_layout[0,:] = pngs["PAE"]
+        PNGS_layout[1:3,:2] = pngs["coverage"]
+        PNGS_layout[1:3,2:4] = pngs["plddt"]
         return PNGS_layout
         
 
-        #self.jobsTabs[tabIndex][0][0] = self.PNGS_layout
-
-        
-
 
 class Ui():
     """
@@ -1177,7 +3974,7 @@ class Ui():
 
         self.AlphaFoldCar = pn.Card(title = "Alphafold Configuration")
 
-        self.mainTabs = pn.Tabs(sizing_mode="stretch_both")
+        self.mainTabs = pn.Tabs(sizing_mode="stretch_both", dynamic=True) # Tabs are only rendered when they are shown
 
     def servable(self):
         self.mainUI.servable()
@@ -1197,45 +3994,213 @@ class Data():
 
         
 
-host = Host()
-#ssh.init_connect()
-host.init_panels()
-#ssh.hostTab.servable()
-gui = Ui()
-alphafold = Alphafold(host)
-results = Results(host)
-
-#gui.connnectivityCard.append(ssh.hostTab)
-#gui.AlphaFoldCar.append(alphafold.AlphaFoldTab)
-
-#Add Settings
-gui.mainTabs.append(("Settings",pn.Column(
-        pn.Row(
-            pn.Card(alphafold.msaTab,title="Sequence Search", collapsible=False),
-            pn.Card(alphafold.modelTab, title="AlphaFoldModel", collapsible=False)
-            ),
-        # alphafold.GOGOGO,
-        pn.WidgetBox(alphafold.editor),
+class Session():
+    """
+    Objects and template of one browser session. Every session has its own widgets, parameters and terminal,
+    the connexion pool, GPU telemetry, GPU scheduler and job tracker are shared (see get_shared).
+    panel serve runs this script for every session; Session can also be served as a factory:
+    pn.serve(lambda: Session().template), which works with --num-threads and --num-procs
+    (shared services are per process).
+    """
+    def __init__(self):
+        self.host = Host()
+        self.host.init_panels()
+        startup_step("host")
+        self.gui = Ui()
+        #The submit button and the jobs of the session need the Alphafold object from the start,
+        #its panes and the Results are only built when their tab is first shown (see show_tab)
+        self.alphafold = Alphafold(self.host)
+        self._results = None
+        startup_step("alphafold")
+
+        self.tabBuilders = {} # index of a tab not built yet -> function returning its content
+        self.add_lazy_tab("Settings", lambda: pn.Column(
+                pn.Row(
+                    pn.Card(self.alphafold.msaTab,title="Sequence Search", collapsible=False),
+                    pn.Card(self.alphafold.modelTab, title="AlphaFoldModel", collapsible=False)
+                    ),
+                pn.WidgetBox(self.alphafold.editor),
+                )
+            )
+        self.add_lazy_tab("Terminal", lambda: pn.Column(self.host.terminalLayout,
+                                                        pn.Card(self.alphafold.jobsTable, title="Jobs", collapsible=False),
+                                                        self.host.telemetryCard))
+        self.add_lazy_tab("Results", lambda: self.results.mainLayout)
+
+        self.template = pn.template.VanillaTemplate(title='AlphaFold @ I2BC', sidebar_width=400)
+        self.template.sidebar.append(pn.Column(
+            pn.WidgetBox(self.host.hostTab),
+            self.host.compressTransferPanel,
+            self.alphafold.GOGOGO,
+            )
         )
-    )
-)
-#Add Terminal
-gui.mainTabs.append(("Terminal",pn.Column(host.terminalLayout)))
+        self.template.main.append(self.gui.mainTabs)
+        self.gui.mainTabs.param.watch(self.show_tab, "active")
+        self.gui.mainTabs.active=0
+        self.show_tab()
+        try:
+            pn.state.on_session_destroyed(self.close)
+        except RuntimeError:
+            pass #No document (not served)
+
+    @property
+    def results(self):
+        if self._results is None:
+            self._results = Results(self.host)
+        return self._results
+
+    def add_lazy_tab(self, title, builder):
+        self.tabBuilders[len(self.gui.mainTabs)] = builder
+        self.gui.mainTabs.append((title, pn.Column(pn.pane.Markdown(f"*Loading {title}...*"), sizing_mode="stretch_both")))
+
+    def show_tab(self, *event):
+        """
+        Fill the active tab the first time it is shown.
+        """
+        index = self.gui.mainTabs.active
+        builder = self.tabBuilders.pop(index, None)
+        if builder is not None:
+            self.gui.mainTabs[index].objects = [builder()]
 
-#Add Results
-gui.mainTabs.append(("Results",results.mainLayout))
+    def close(self, session_context):
+        """
+        End of the session: release the shared services.
+        """
+        self.host.detach_services()
+        callbacks = [self.alphafold.tableCallback]
+        if self._results is not None:
+            callbacks.append(self._results.refreshCallback)
+        for callback in callbacks:
+            if callback is not None:
+                callback.stop()
 
-# gui.servable()
+    def servable(self):
+        return self.template.servable()
 
-mainGUI = pn.template.VanillaTemplate(title='AlphaFold @ I2BC', sidebar_width=400)
-# mainGUI = pn.template.GoldenTemplate(title='Golden Template')
-mainGUI.sidebar.append(pn.Column(
-    pn.WidgetBox(host.hostTab),
-    alphafold.GOGOGO,   
-    )
-)
-mainGUI.main.append(gui.mainTabs)
-gui.mainTabs.active=0
 
-mainGUI.servable()
+def open_submitter(serverName, workdir="", user=None, password=None):
+    """
+    Python API, without panels nor bokeh server:
+        submitter = alphasub.open_submitter("cluster-i2bc")
+        jobs = submitter.submit(alphasub.JobSpec("myjob", "/path/on/host/myjob", query="MKV...", numRecycle=6))
+        submitter.status([job.workdir for job in jobs])
+    """
+    return Submitter(Host().init_headless(serverName, workdir, user, password))
+
+
+def read_spec_inputs(spec, paths):
+    """
+    Put the content of fasta or A3M files in a JobSpec (A3M files all go in the same job).
+    """
+    for path in paths:
+        with open(path, "rb") as f:
+            content = f.read()
+        if path.lower().endswith(".a3m"):
+            spec.msas.append((os.path.basename(path), content))
+        else:
+            spec.fasta = content.decode("utf-8")
+    return spec
+
+
+def build_specs(args):
+    """
+    JobSpecs of the submit command. Raises ValueError for unknown parameters.
+    """
+    parameters = {}
+    if args.spec is not None:
+        with open(args.spec) as f:
+            parameters.update(json.load(f))
+    for item in args.set:
+        name, _, value = item.partition("=")
+        try:
+            parameters[name] = json.loads(value)
+        except ValueError:
+            parameters[name] = value
+
+    fastas = [path for path in args.inputs if not path.lower().endswith(".a3m")]
+    a3ms = [path for path in args.inputs if path.lower().endswith(".a3m")]
+    if args.query is not None or len(a3ms) > 0 or len(fastas) <= 1:
+        first = (a3ms + fastas)[0] if len(a3ms + fastas) > 0 else "query"
+        jobname = args.jobname if args.jobname is not None else Path(first).stem
+        return [read_spec_inputs(JobSpec(jobname, args.workdir, query=args.query or "", **parameters), a3ms or fastas)]
+    return [read_spec_inputs(JobSpec(Path(path).stem, f"{args.workdir.rstrip('/')}/{Path(path).stem}", **parameters), [path]) for path in fastas]
+
+
+def main(argv):
+    """
+    Command line, same servers.json, script generation and transfers as the web interface:
+        python alphasub.py --server cluster-i2bc submit --workdir /path/on/host proteins/*.fasta --set numRecycle=6
+        python alphasub.py --server cluster-i2bc status /path/on/host/*
+    Several fasta files give one job each, in a sub-folder of the workdir named after the file.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="alphasub", description="Submit and follow AlphaFold jobs without the web interface.")
+    parser.add_argument("--server", default="local", help="server of ~/.alphasub/servers.json (default: local)")
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="submit jobs")
+    submit.add_argument("inputs", nargs="*", help="fasta files (one job each) or A3M files (one job for all of them)")
+    submit.add_argument("--query", default=None, help="sequence(s) to predict instead of files")
+    submit.add_argument("--workdir", required=True, help="folder of the job on the host (parent folder with several fasta files)")
+    submit.add_argument("--jobname", default=None, help="default: name of the input file")
+    submit.add_argument("--spec", default=None, help="JSON file of job parameters (names of JobSpec.DEFAULTS)")
+    submit.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="job parameter, the value is read as JSON when possible (e.g. --set numRecycle=6)")
+    submit.add_argument("--no-launch", action="store_true", help="upload the files without launching the scripts")
+    submit.add_argument("--parallel", type=int, default=4, help="jobs submitted at the same time (default: 4)")
+    status = commands.add_parser("status", help="stage of submitted jobs")
+    status.add_argument("workdirs", nargs="+", help="folders of the jobs (or batches) on the host")
+    args = parser.parse_args(argv)
+
+    if args.command == "submit":
+        #Bad parameters or inputs are reported before connecting
+        try:
+            specs = build_specs(args)
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+    try:
+        submitter = open_submitter(args.server, user=args.user, password=args.password)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.command == "status":
+        jobs = submitter.status(args.workdirs)
+        for job in jobs:
+            print("\t".join([job.jobname, job.workdir, job.stage, ",".join(job.pbsIds), job.queue, job.message]))
+        return 1 if any(job.stage == "failed" for job in jobs) else 0
+
+    def submit_spec(spec):
+        try:
+            return submitter.submit(spec, launch=not args.no_launch)
+        except ValueError as e:
+            print(f"{spec.jobname}: {e}", file=sys.stderr)
+            return []
+    parallel = max(1, args.parallel)
+    if not submitter.HOST.local:
+        #Each job holds an exec channel, next to the transfer channels and the SFTP client (see SSHPool)
+        pool = submitter.HOST.pool
+        limit = max(1, pool.maxSessions - pool.transferChannels - 1)
+        if parallel > limit:
+            print(f"--parallel {parallel} would open more than {pool.maxSessions} channels on the connexion, using {limit}", file=sys.stderr)
+            parallel = limit
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        submitted = [job for jobs in executor.map(submit_spec, specs) for job in jobs]
+    if submitter.HOST.local and not args.no_launch:
+        submitter.HOST.localExecutor.wait()
+    for job in submitted:
+        print("\t".join([job.jobname, job.workdir, job.stage, ",".join(job.pbsIds), job.message]))
+    return 0 if len(submitted) > 0 and not any(job.stage == "failed" for job in submitted) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+elif __name__.startswith("bokeh_app"):
+    #Served by panel serve: a new Session for every browser session. Imported as a module, nothing is built.
+    startup_step("extensions")
+    session = Session()
+    host, gui, alphafold, mainGUI = session.host, session.gui, session.alphafold, session.template
+
+    session.servable()
+    startup_step("template")
+    if os.environ.get("ALPHASUB_STARTUP_REPORT"):
+        print(startup_report())
 
@@ -0,0 +1,207 @@
+"""
+Post-processing of the A3M files of a job, run on the host by run_pred.sh.
+Standalone (python3 standard library only): it is uploaded next to the scripts of every job.
+
+    python3 alphasub_a3m.py rename DIR       rename every DIR/*.a3m after its first header
+    python3 alphasub_a3m.py nmer DIR NMER    set the cardinality of the "#len<TAB>card" line to NMER
+    python3 alphasub_a3m.py check FILE...    validate A3M/FASTA files and print their stats
+
+Everything is done in a single process and only the header lines are read.
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+
+CARDINALITY = re.compile(rb"^(#[0-9]*\t)[0-9]+")
+HEADER_LINE = re.compile(r"^#([0-9]+(?:,[0-9]+)*)\t([0-9]+(?:,[0-9]+)*)$")
+QUERY_ALPHABET = re.compile(r"^[A-Z]+$")
+A3M_ALPHABET = re.compile(r"^[A-Za-z\-\.\*]+$")
+FASTA_ALPHABET = re.compile(r"^[A-Za-z\*:]+$")
+MAX_ERRORS = 10 # Errors reported per file
+
+
+def a3m_files(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".a3m"))
+
+
+def first_header(path):
+    """
+    Name of the first sequence of an A3M (header up to the first tab), None if there is none.
+    """
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                return line[1:].decode("utf-8", errors="replace").strip().split("\t")[0]
+    return None
+
+
+def rename(folder):
+    """
+    Rename every A3M of folder after its first header. Returns the list of (old, new) names.
+    """
+    renamed = []
+    for path in a3m_files(folder):
+        name = first_header(path)
+        if name is None or name == "":
+            continue
+        target = os.path.join(folder, f"{name}.a3m")
+        if target != path:
+            os.replace(path, target)
+            renamed.append((os.path.basename(path), os.path.basename(target)))
+    return renamed
+
+
+def set_cardinality(path, nmer):
+    """
+    Replace the cardinality of the first line ("#len<TAB>card") by nmer.
+    The line is overwritten in place when its length doesn't change, otherwise the file is copied once.
+    Hard-linked files (MSA cache hits) are always copied: the other links keep their content.
+    Returns True if the file was modified.
+    """
+    with open(path, "r+b") as f:
+        line = f.readline()
+        patched = CARDINALITY.sub(lambda m: m.group(1) + str(nmer).encode(), line, count=1)
+        if patched == line:
+            return False
+        if len(patched) == len(line) and os.fstat(f.fileno()).st_nlink == 1:
+            f.seek(0)
+            f.write(patched)
+            return True
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", delete=False)
+        with tmp:
+            tmp.write(patched)
+            shutil.copyfileobj(f, tmp, 1024*1024)
+    shutil.copymode(path, tmp.name)
+    os.replace(tmp.name, path)
+    return True
+
+
+def set_nmer(folder, nmer):
+    return [os.path.basename(path) for path in a3m_files(folder) if set_cardinality(path, nmer)]
+
+
+def read_records(text):
+    """
+    Return (first line if it starts with #, [(header, sequence)], errors) of a FASTA/A3M content.
+    """
+    records = []
+    errors = []
+    header = None
+    seq = []
+    comment = None
+    for i, line in enumerate(text.splitlines()):
+        line = line.strip()
+        if line == "":
+            continue
+        if line.startswith("#"):
+            if i == 0:
+                comment = line
+            continue
+        if line.startswith(">"):
+            if header is not None:
+                records.append((header, "".join(seq)))
+            header = line[1:].strip()
+            seq = []
+            if header == "":
+                errors.append(f"line {i+1}: empty header")
+        elif header is None:
+            errors.append(f"line {i+1}: sequence before the first header")
+            header = ""
+            seq = [line]
+        else:
+            seq.append(line)
+    if header is not None:
+        records.append((header, "".join(seq)))
+    return comment, records, errors
+
+
+def validate(name, content):
+    """
+    Check an A3M or FASTA file (content in bytes) and extract its stats. Returns a dict with
+    name, kind, errors, queryLength, chains (lengths), cardinality, depth (number of sequences)
+    and lengths (residues of every sequence of a FASTA file).
+    """
+    kind = "a3m" if name.lower().endswith(".a3m") else "fasta"
+    stats = {"name": name, "kind": kind, "errors": [], "queryLength": 0, "chains": [], "cardinality": [], "depth": 0, "lengths": []}
+    errors = stats["errors"]
+    try:
+        text = content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        errors.append(f"not a text file ({e})")
+        return stats
+    comment, records, parseErrors = read_records(text)
+    errors += parseErrors
+    if len(records) == 0:
+        errors.append("no sequence found")
+        return stats
+    stats["depth"] = len(records)
+
+    if kind == "fasta":
+        for header, seq in records:
+            if seq == "":
+                errors.append(f"{header}: empty sequence")
+            elif not FASTA_ALPHABET.match(seq):
+                errors.append(f"{header}: unexpected characters {sorted(set(re.sub('[A-Za-z*:]', '', seq)))}")
+            stats["lengths"].append(len(seq.replace(":", "").replace("*", "")))
+        stats["queryLength"] = max(stats["lengths"])
+        stats["chains"] = [len(chain) for chain in records[0][1].split(":")]
+        return stats
+
+    header, query = records[0]
+    if not QUERY_ALPHABET.match(query):
+        errors.append(f"query {header}: only upper case residues are allowed in the query")
+    stats["queryLength"] = len(query)
+    stats["chains"] = [len(query)]
+    stats["cardinality"] = [1]
+    if comment is not None:
+        match = HEADER_LINE.match(comment)
+        if match is None:
+            errors.append(f"malformed first line {comment!r}, expected #len<TAB>cardinality")
+        else:
+            chains = [int(n) for n in match.group(1).split(",")]
+            cardinality = [int(n) for n in match.group(2).split(",")]
+            if len(chains) != len(cardinality):
+                errors.append(f"{len(chains)} chain lengths but {len(cardinality)} cardinalities in {comment!r}")
+            if sum(chains) != len(query):
+                errors.append(f"query length {len(query)} doesn't match the chain lengths of {comment!r}")
+            stats["chains"] = chains
+            stats["cardinality"] = cardinality
+    for header, seq in records[1:]:
+        if len(errors) >= MAX_ERRORS:
+            break
+        if not A3M_ALPHABET.match(seq):
+            errors.append(f"{header}: unexpected characters")
+            continue
+        columns = sum(1 for c in seq if c.isupper() or c == "-")
+        if columns != len(query):
+            errors.append(f"{header}: {columns} aligned columns, the query has {len(query)}")
+    return stats
+
+
+def main(argv):
+    if len(argv) >= 2 and argv[0] == "rename":
+        for old, new in rename(argv[1]):
+            print(f"{old} -> {new}")
+    elif len(argv) >= 3 and argv[0] == "nmer":
+        modified = set_nmer(argv[1], int(argv[2]))
+        print(f"Cardinality set to {argv[2]} in {len(modified)} file(s)")
+    elif len(argv) >= 2 and argv[0] == "check":
+        failed = 0
+        for path in argv[1:]:
+            with open(path, "rb") as f:
+                stats = validate(os.path.basename(path), f.read())
+            failed += len(stats["errors"]) > 0
+            print(f"{path}: {stats['kind']}, query {stats['queryLength']} residues, chains {stats['chains']}, depth {stats['depth']}")
+            for error in stats["errors"]:
+                print(f"    {error}")
+        return 1 if failed else 0
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,37 @@
+"""
+Summary of the *_scores.json files of a predictions folder, used by the results summary table.
+Standalone (python3 standard library only) so it can run in the workers of a process pool.
+
+    python3 alphasub_scores.py FILE...    print mean pLDDT, pTM, ipTM and max PAE of each scores file
+
+Only the scalar scores are kept, the PAE matrix is read by alphasub.load_pae.
+"""
+import json
+import sys
+
+NAN = float("nan")
+EMPTY = {"Mean pLDDT": NAN, "pTM": NAN, "ipTM": NAN, "Max PAE": NAN}
+
+
+def summarize(path):
+    """
+    Mean pLDDT, pTM, ipTM (NaN for monomers) and max PAE of a scores file.
+    A file that can't be read or parsed (often still being written by a running job) gives NaN everywhere.
+    """
+    try:
+        with open(path, "r") as f:
+            scores = json.load(f)
+        plddt = scores.get("plddt", [])
+        return {"Mean pLDDT": sum(plddt)/len(plddt) if len(plddt) > 0 else NAN,
+                "pTM": float(scores.get("ptm", NAN)),
+                "ipTM": float(scores.get("iptm", NAN)),
+                "Max PAE": float(scores.get("max_pae", NAN)),
+                }
+    except (OSError, ValueError, TypeError, AttributeError):
+        return dict(EMPTY)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        values = summarize(path)
+        print(path + "\t" + "\t".join(f"{name}={value:.3f}" for name, value in values.items()))
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("panel")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import alphasub
+
+
+QSTAT = """Job id            Name             User              Time Use S Queue
+----------------  ---------------- ----------------  -------- - -----
+123.pbsserver     run_pred.sh      user              00:01:02 R cryoem
+124.pbsserver     run_pred.sh      user              0        Q cryoem
+125.pbsserver     run_search.sh    user              0        Q cpu
+126.pbsserver     run_pred.sh      user              0        Q cryoem
+""".splitlines()
+
+
+def test_parse_qstat():
+    jobs = alphasub.JobTracker.parse_qstat(QSTAT)
+    assert jobs == {"123": ("R", "cryoem", None),
+                    "124": ("Q", "cryoem", 1),
+                    "125": ("Q", "cpu", 1),
+                    "126": ("Q", "cryoem", 2)}
+
+
+def test_parse_qstat_empty():
+    assert alphasub.JobTracker.parse_qstat([]) == {}
+    assert alphasub.JobTracker.parse_qstat(QSTAT[:2]) == {}
+
+
+@pytest.mark.parametrize("files, doModels, stage", [
+    ([], True, None),
+    (["run_pred.sh"], True, None),
+    (["searchingSequences"], True, "searching"),
+    (["searchingSequences", "searchingSequencesDone"], True, "searching"),
+    (["searchingSequences", "searchingSequencesDone"], False, "done"),
+    (["searchingSequencesDone", "makingModels"], True, "modelling"),
+    (["searchingSequencesDone", "makingModels", "makingModelsDone"], True, "done"),
+])
+def test_stage_from_files(files, doModels, stage):
+    job = alphasub.JobStatus("p1", "/tmp/p1", "local", doModels=doModels)
+    assert job.stage_from_files(files) == stage
+
+
+def test_parse_fasta():
+    text = "MKV\n>p1 first\nMKV\nAGG\n\n>p2\nMK:VV\n>empty\n"
+    assert alphasub.parse_fasta(text) == [("seq0", "MKV"), ("p1 first", "MKVAGG"), ("p2", "MK:VV"), ("empty", "")]
+    assert alphasub.parse_fasta("") == []
+
+
+def test_chunk_list():
+    assert alphasub.chunk_list(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
+    assert alphasub.chunk_list(list(range(3)), 0) == [[0], [1], [2]]
+    assert alphasub.chunk_list([], 10) == []
+
+
+def test_estimate_gpu_memory():
+    assert alphasub.estimate_gpu_memory(0) == 2000
+    assert alphasub.estimate_gpu_memory(1000, depth=0) == 2000 + 2500
+    #The depth is capped at the 5120 sequences of the extra MSA stack
+    assert alphasub.estimate_gpu_memory(1000, depth=10000) == alphasub.estimate_gpu_memory(1000)
+    assert alphasub.estimate_gpu_memory(1000, depth=100) < alphasub.estimate_gpu_memory(1000)
+
+
+def test_estimate_resources():
+    small = alphasub.estimate_resources([100])
+    assert small["residues"] == 100
+    assert small["seconds"] == 3600 #At least one hour
+    assert small["walltime"] == "01:00:00"
+    assert small["gpuMemory"] == alphasub.estimate_gpu_memory(100)
+
+    batch = alphasub.estimate_resources([2000, 500, 0])
+    large = alphasub.estimate_resources([2000])
+    assert batch["residues"] == 2000
+    assert batch["gpuMemory"] == large["gpuMemory"]
+    assert batch["mem"] == large["mem"]
+    assert batch["seconds"] > large["seconds"] #The predictions run one after the other
+    assert alphasub.estimate_resources([2000], relax=True, gpuRelax=False)["mem"] == large["mem"] + 4
@@ -0,0 +1,87 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import alphasub_a3m
+
+
+A3M = b"#120\t1\n>101\nMKV\n>seq2\nMKI\n"
+
+
+def test_set_cardinality_in_place(tmp_path):
+    path = tmp_path / "a.a3m"
+    path.write_bytes(A3M)
+    inode = os.stat(path).st_ino
+    assert alphasub_a3m.set_cardinality(str(path), 2)
+    assert path.read_bytes() == b"#120\t2\n>101\nMKV\n>seq2\nMKI\n"
+    assert os.stat(path).st_ino == inode
+
+
+def test_set_cardinality_longer_line(tmp_path):
+    path = tmp_path / "a.a3m"
+    path.write_bytes(A3M)
+    assert alphasub_a3m.set_cardinality(str(path), 12)
+    assert path.read_bytes() == b"#120\t12\n>101\nMKV\n>seq2\nMKI\n"
+
+
+def test_set_cardinality_unchanged(tmp_path):
+    path = tmp_path / "a.a3m"
+    path.write_bytes(A3M)
+    assert not alphasub_a3m.set_cardinality(str(path), 1)
+    assert path.read_bytes() == A3M
+
+
+def test_set_cardinality_keeps_hard_links(tmp_path):
+    #MSA cache hits are hard links to the cache entry, which must keep its cardinality
+    cached = tmp_path / "cache.a3m"
+    cached.write_bytes(A3M)
+    cached.chmod(0o644)
+    path = tmp_path / "a.a3m"
+    os.link(cached, path)
+    assert alphasub_a3m.set_cardinality(str(path), 2)
+    assert path.read_bytes() == b"#120\t2\n>101\nMKV\n>seq2\nMKI\n"
+    assert cached.read_bytes() == A3M
+    assert os.stat(path).st_nlink == 1
+    assert os.stat(path).st_mode & 0o777 == 0o644
+
+
+def test_validate_a3m():
+    stats = alphasub_a3m.validate("a.a3m", b"#3,2\t1,2\n>101\nMKVAG\n>seq2\nMK-aAG\n")
+    assert stats["errors"] == []
+    assert stats["chains"] == [3, 2]
+    assert stats["cardinality"] == [1, 2]
+    assert stats["queryLength"] == 5
+    assert stats["depth"] == 2
+
+
+def test_validate_bad_header():
+    stats = alphasub_a3m.validate("a.a3m", b"#3 1\n>101\nMKV\n")
+    assert len(stats["errors"]) == 1
+    assert "malformed first line" in stats["errors"][0]
+
+
+def test_validate_cardinality_mismatch():
+    stats = alphasub_a3m.validate("a.a3m", b"#3,2\t1\n>101\nMKVAG\n")
+    assert any("1 cardinalities" in error for error in stats["errors"])
+
+
+def test_validate_length_mismatch():
+    stats = alphasub_a3m.validate("a.a3m", b"#4\t1\n>101\nMKV\n>seq2\nMK\n")
+    assert any("query length 3" in error for error in stats["errors"])
+    assert any("seq2: 2 aligned columns" in error for error in stats["errors"])
+
+
+def test_validate_bad_alphabet():
+    stats = alphasub_a3m.validate("a.a3m", b"#3\t1\n>101\nMkV\n>seq2\nM1V\n")
+    assert any("only upper case" in error for error in stats["errors"])
+    assert any("seq2: unexpected characters" in error for error in stats["errors"])
+    stats = alphasub_a3m.validate("a.fasta", b">p1\nMKV:MK\n>p2\nMK#V\n")
+    assert stats["errors"] == ["p2: unexpected characters ['#']"]
+    assert stats["chains"] == [3, 2]
+    assert stats["lengths"] == [5, 4]
+
+
+def test_validate_sequence_before_header():
+    stats = alphasub_a3m.validate("a.fasta", b"MKV\n>p1\nMKV\n")
+    assert stats["errors"] == ["line 1: sequence before the first header"]
+    assert stats["depth"] == 2